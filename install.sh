@@ -70,7 +70,7 @@ if [ ! -f "$RUN_SCRIPT" ]; then
 #!/bin/bash
 cd "\$(dirname "\$0")"
 source venv/bin/activate
-exec python3 bot.py
+exec python3 src/telegram_bot.py
 EOF
     chmod +x "$RUN_SCRIPT"
     echo "run.sh created and made executable."
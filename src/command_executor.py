@@ -1,192 +1,701 @@
+import asyncio
+import shlex
+import shutil
 import subprocess
 import logging
 import os
-from typing import Dict, Any, List
+import functools
+import hashlib
+import re
+import secrets
+import select
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from io import BytesIO, StringIO
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Tuple, Callable, Optional, Union
 import paramiko
 
 logger = logging.getLogger(__name__)
 
-def _execute_shell(command: str) -> Dict[str, Any]:
+@dataclass(slots=True)
+class CommandResult:
+    """The outcome of a single executed command."""
+    command: str
+    stdout: str
+    stderr: str
+    returncode: int
+    # Set when stdout or stderr was cut down to its head and tail at capture
+    truncated: bool = False
+
+# Bytes of command output kept from each end of stdout/stderr; anything in
+# between is dropped while the command is still running.
+OUTPUT_CAPTURE_BYTES = 4096
+# READ_FILE keeps much more, since the model may edit what it reads; files
+# larger than twice this are still cut in the middle
+READ_FILE_CAPTURE_BYTES = 32768
+_PIPE_READ_SIZE = 65536
+
+class _CappedOutput:
+    """
+    Collects a command's output stream, keeping only its first and last
+    `limit` bytes.
+    """
+    __slots__ = ("limit", "head", "tail", "omitted")
+
+    def __init__(self, limit: int = OUTPUT_CAPTURE_BYTES):
+        self.limit = limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.omitted = 0
+
+    def feed(self, data: bytes):
+        room = self.limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if not data:
+            return
+        self.tail += data
+        excess = len(self.tail) - self.limit
+        if excess > 0:
+            del self.tail[:excess]
+            self.omitted += excess
+
+    def skip(self, count: int):
+        """Records `count` bytes that were dropped without being read."""
+        self.omitted += count
+
+    @property
+    def truncated(self) -> bool:
+        return self.omitted > 0
+
+    def text(self) -> str:
+        """Decodes the kept output, marking where bytes were dropped."""
+        if not self.omitted:
+            return (self.head + self.tail).strip().decode('utf-8', 'replace')
+        head = self.head.decode('utf-8', 'replace')
+        tail = self.tail.decode('utf-8', 'replace')
+        return f"{head}\n... [{self.omitted} bytes omitted] ...\n{tail}".strip()
+
+def _capped_result(command: str, stdout: _CappedOutput, stderr: _CappedOutput, returncode: int) -> CommandResult:
+    """Builds a CommandResult from captured streams."""
+    return CommandResult(
+        command=command,
+        stdout=stdout.text(),
+        stderr=stderr.text(),
+        returncode=returncode,
+        truncated=stdout.truncated or stderr.truncated,
+    )
+
+class _BatchStream:
+    """
+    Splits one stream of a batched SSH script on its per-command markers as
+    data arrives, keeping each command's share in its own _CappedOutput.
+    `pattern` matches a marker (with the exit code as group 1, if any) and
+    `lookbehind` is the longest marker, so a marker cut between two reads is
+    held back until it is complete.
+    """
+    __slots__ = ("pattern", "lookbehind", "pending", "outputs", "codes")
+
+    def __init__(self, pattern: "re.Pattern[bytes]", lookbehind: int):
+        self.pattern = pattern
+        self.lookbehind = lookbehind
+        self.pending = bytearray()
+        self.outputs = [_CappedOutput()]
+        self.codes: List[Optional[int]] = []
+
+    def feed(self, data: bytes):
+        self.pending += data
+        start = 0
+        for match in self.pattern.finditer(self.pending):
+            self.outputs[-1].feed(self.pending[start:match.start()])
+            self.codes.append(int(match.group(1)) if match.lastindex else None)
+            self.outputs.append(_CappedOutput())
+            start = match.end()
+        safe = max(start, len(self.pending) - self.lookbehind)
+        self.outputs[-1].feed(self.pending[start:safe])
+        del self.pending[:safe]
+
+    def close(self):
+        self.outputs[-1].feed(self.pending)
+        self.pending.clear()
+
+# Directories _write_file has already created (or found), bounded FIFO-style
+_MKDIR_CACHE_SIZE = 1024
+_known_dirs: set = set()
+_known_dirs_order: deque = deque()
+_known_dirs_lock = threading.Lock()
+
+# --- SSH connection cache ---
+# Connections are keyed by (host, port, username, key fingerprint) and reused
+# across commands so a batch against one host pays for a single handshake.
+_ssh_clients: Dict[Tuple[str, int, str, str], paramiko.SSHClient] = {}
+_sftp_clients: Dict[Tuple[str, int, str, str], paramiko.SFTPClient] = {}
+# _ssh_lock only guards the dicts. Connecting and opening SFTP sessions happen
+# under a per-connection lock, so a slow or unreachable host only holds up
+# callers for that same host.
+_ssh_lock = threading.Lock()
+_ssh_key_locks: Dict[Tuple[str, int, str, str], threading.Lock] = {}
+# Seconds between keepalive packets on idle connections, so a cached
+# connection is not silently dropped by NAT or firewall idle timeouts
+_SSH_KEEPALIVE_INTERVAL = 30
+# Receive window advertised for new channels (paramiko defaults to 2 MB), so
+# large command output and SFTP downloads are not throttled by window updates.
+# It only covers data the server sends; uploads (WRITE_FILE over SFTP) are
+# limited by the window the server advertises.
+_SSH_WINDOW_SIZE = 2 ** 27
+_SSH_RECV_SIZE = 2 ** 16
+
+# Characters that only /bin/sh can interpret. Commands free of them (plain
+# whitespace-separated words) are executed directly without a shell.
+_SHELL_META = frozenset("|&;<>()$`\\\"'*?[]{}#~=%!\n")
+
+def _direct_argv(command: str) -> Optional[List[str]]:
+    """Returns an argv for commands that need no shell features, otherwise None."""
+    if _SHELL_META.intersection(command):
+        return None
+    argv = shlex.split(command)
+    return argv or None
+
+def _spawn_process(command: str) -> subprocess.Popen:
+    """Starts a command directly when possible, falling back to /bin/sh."""
+    # Keep CPython on its posix_spawn fast path (no full fork of this process):
+    # the executable must be given as a path, close_fds must be False (our own
+    # descriptors are non-inheritable anyway, PEP 446), and preexec_fn, pass_fds,
+    # cwd, start_new_session and uid/gid changes must not be used.
+    argv = _direct_argv(command)
+    executable = shutil.which(argv[0]) if argv else None
+    if executable is not None:
+        try:
+            return subprocess.Popen(
+                argv, executable=executable, shell=False, close_fds=False,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+        except FileNotFoundError:
+            pass  # Removed between lookup and exec; let the shell report it
+    # Shell builtins (e.g. cd) and anything using shell syntax run under /bin/sh
+    return subprocess.Popen(
+        command, shell=True, close_fds=False,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+
+def _communicate_capped(process: subprocess.Popen, timeout: float) -> Tuple[_CappedOutput, _CappedOutput, int]:
+    """
+    Drains both pipes of a process into capped buffers and waits for it to exit.
+    Kills the process and raises subprocess.TimeoutExpired after `timeout` seconds.
+    """
+    stdout, stderr = _CappedOutput(), _CappedOutput()
+    sinks = {process.stdout: stdout, process.stderr: stderr}
+    deadline = time.monotonic() + timeout
+    try:
+        with selectors.DefaultSelector() as selector:
+            for pipe in sinks:
+                selector.register(pipe, selectors.EVENT_READ)
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(process.args, timeout)
+                for key, _ in selector.select(remaining):
+                    chunk = os.read(key.fd, _PIPE_READ_SIZE)
+                    if chunk:
+                        sinks[key.fileobj].feed(chunk)
+                    else:
+                        selector.unregister(key.fileobj)
+        returncode = process.wait(timeout=max(0, deadline - time.monotonic()))
+    except BaseException:
+        process.kill()
+        raise
+    return stdout, stderr, returncode
+
+def _execute_shell(command: str) -> CommandResult:
     """Executes a single shell command."""
     logger.info(f"Executing shell command: {command}")
     try:
-        process = subprocess.run(
+        with _spawn_process(command) as process:
+            stdout, stderr, returncode = _communicate_capped(process, timeout=180)  # 3-minute timeout
+        return _capped_result(command, stdout, stderr, returncode)
+    except subprocess.TimeoutExpired:
+        logger.warning(f"Command '{command}' timed out.")
+        return CommandResult(command, "", "Command timed out after 3 minutes.", -1)
+    except Exception as e:
+        logger.error(f"Failed to execute command '{command}': {e}")
+        return CommandResult(command, "", str(e), -1)
+
+async def _execute_shell_async(command: str) -> CommandResult:
+    """Executes a single shell command without blocking the event loop."""
+    logger.info(f"Executing shell command (async): {command}")
+    try:
+        process = await asyncio.create_subprocess_shell(
             command,
-            shell=True,
-            capture_output=True,
-            text=True,
-            check=False,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+    except Exception as e:
+        logger.error(f"Failed to execute command '{command}': {e}")
+        return CommandResult(command, "", str(e), -1)
+
+    async def drain(stream: asyncio.StreamReader, sink: _CappedOutput):
+        while chunk := await stream.read(_PIPE_READ_SIZE):
+            sink.feed(chunk)
+
+    stdout, stderr = _CappedOutput(), _CappedOutput()
+    try:
+        # Both pipes are drained concurrently by the event loop
+        await asyncio.wait_for(
+            asyncio.gather(drain(process.stdout, stdout), drain(process.stderr, stderr)),
             timeout=180  # 3-minute timeout
         )
-        return {
-            "command": command,
-            "stdout": process.stdout.strip(),
-            "stderr": process.stderr.strip(),
-            "returncode": process.returncode,
-        }
-    except subprocess.TimeoutExpired:
+        returncode = await process.wait()
+        return _capped_result(command, stdout, stderr, returncode)
+    except asyncio.TimeoutError:
         logger.warning(f"Command '{command}' timed out.")
-        return {"command": command, "stdout": "", "stderr": "Command timed out after 3 minutes.", "returncode": -1}
+        process.kill()
+        await process.wait()
+        return CommandResult(command, "", "Command timed out after 3 minutes.", -1)
     except Exception as e:
         logger.error(f"Failed to execute command '{command}': {e}")
-        return {"command": command, "stdout": "", "stderr": str(e), "returncode": -1}
+        return CommandResult(command, "", str(e), -1)
 
-def _read_file(path: str) -> Dict[str, Any]:
+def _read_fd(fd: int) -> _CappedOutput:
+    """
+    Reads an open file descriptor into a capped buffer. When fstat reports a
+    file larger than the cap, the middle is skipped with a seek instead of read.
+    """
+    output = _CappedOutput(READ_FILE_CAPTURE_BYTES)
+    size = os.fstat(fd).st_size
+    if size > 2 * output.limit:
+        output.feed(os.read(fd, output.limit))
+        tail_start = size - output.limit
+        output.skip(tail_start - os.lseek(fd, 0, os.SEEK_CUR))
+        os.lseek(fd, tail_start, os.SEEK_SET)
+    # Files that grow while being read, or report no size (e.g. under /proc), are read to EOF
+    while chunk := os.read(fd, _PIPE_READ_SIZE):
+        output.feed(chunk)
+    return output
+
+def _read_file(path: str) -> CommandResult:
     """Reads the content of a file."""
     logger.info(f"Reading file: {path}")
     try:
-        with open(path, 'r') as f:
-            content = f.read()
-        return {"command": f"READ_FILE {path}", "stdout": content, "stderr": "", "returncode": 0}
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            content = _read_fd(fd)
+        finally:
+            os.close(fd)
+        return CommandResult(f"READ_FILE {path}", content.text(), "", 0, truncated=content.truncated)
     except Exception as e:
         logger.error(f"Failed to read file '{path}': {e}")
-        return {"command": f"READ_FILE {path}", "stdout": "", "stderr": str(e), "returncode": 1}
+        return CommandResult(f"READ_FILE {path}", "", str(e), 1)
 
-def _write_file(path: str, content: str) -> Dict[str, Any]:
-    """Writes content to a file."""
+def _ensure_dir(dir_name: str):
+    """Creates a directory tree unless it is already known to exist."""
+    if dir_name in _known_dirs:
+        return
+    os.makedirs(dir_name, exist_ok=True)
+    with _known_dirs_lock:
+        if dir_name not in _known_dirs:
+            _known_dirs.add(dir_name)
+            _known_dirs_order.append(dir_name)
+            if len(_known_dirs_order) > _MKDIR_CACHE_SIZE:
+                _known_dirs.discard(_known_dirs_order.popleft())
+
+def _forget_dir(dir_name: str):
+    """Drops a directory from the cache, e.g. after it was removed behind our back."""
+    with _known_dirs_lock:
+        if dir_name in _known_dirs:
+            _known_dirs.discard(dir_name)
+            _known_dirs_order.remove(dir_name)
+
+def _write_file(path: str, content: Union[bytes, memoryview]) -> CommandResult:
+    """Writes UTF-8 encoded content to a file."""
     logger.info(f"Writing to file: {path}")
     try:
         dir_name = os.path.dirname(path)
         if dir_name:
-            os.makedirs(dir_name, exist_ok=True)
-        with open(path, 'w') as f:
-            f.write(content)
-        return {"command": f"WRITE_FILE {path}", "stdout": f"File '{path}' written successfully.", "stderr": "", "returncode": 0}
+            _ensure_dir(dir_name)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        except FileNotFoundError:
+            if not dir_name or dir_name not in _known_dirs:
+                raise
+            # The cached directory has been removed since; recreate it once
+            _forget_dir(dir_name)
+            _ensure_dir(dir_name)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            view = memoryview(content)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        return CommandResult(f"WRITE_FILE {path}", f"File '{path}' written successfully.", "", 0)
     except Exception as e:
         logger.error(f"Failed to write to file '{path}': {e}")
-        return {"command": f"WRITE_FILE {path}", "stdout": "", "stderr": str(e), "returncode": 1}
+        return CommandResult(f"WRITE_FILE {path}", "", str(e), 1)
 
-def _list_files(path: str) -> Dict[str, Any]:
+def _list_files(path: str) -> CommandResult:
     """Lists files in a directory."""
     logger.info(f"Listing files in: {path}")
     try:
         files = os.listdir(path)
-        return {"command": f"LIST_FILES {path}", "stdout": "\n".join(files), "stderr": "", "returncode": 0}
+        return CommandResult(f"LIST_FILES {path}", "\n".join(files), "", 0)
     except Exception as e:
         logger.error(f"Failed to list files in '{path}': {e}")
-        return {"command": f"LIST_FILES {path}", "stdout": "", "stderr": str(e), "returncode": 1}
+        return CommandResult(f"LIST_FILES {path}", "", str(e), 1)
 
 
-def _execute_ssh(command: str, creds: Dict[str, Any]) -> Dict[str, Any]:
-    """Executes a single shell command on a remote server."""
-    logger.info(f"Executing SSH command: {command} on {creds['host']}")
-    try:
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+def _ssh_cache_key(creds: Dict[str, Any]) -> Tuple[str, int, str, str]:
+    """Builds the connection cache key for a set of SSH credentials."""
+    fingerprint = hashlib.sha256(creds['key'].encode()).hexdigest()
+    return (creds['host'], int(creds['port']), creds['username'], fingerprint)
+
+@functools.lru_cache(maxsize=32)
+def _parse_pkey(key_text: str) -> paramiko.PKey:
+    """Parses a PEM private key once; reconnects with the same key reuse the parsed object."""
+    return paramiko.RSAKey.from_private_key(StringIO(key_text))
+
+def _drop_ssh_client(key: Tuple[str, int, str, str]):
+    """Closes and forgets a cached SSH connection."""
+    with _ssh_lock:
+        sftp = _sftp_clients.pop(key, None)
+        client = _ssh_clients.pop(key, None)
+    for conn in (sftp, client):
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+def _ssh_key_lock(key: Tuple[str, int, str, str]) -> threading.Lock:
+    """Returns the lock serializing connection setup for one cache key."""
+    with _ssh_lock:
+        return _ssh_key_locks.setdefault(key, threading.Lock())
+
+def _cached_ssh_client(key: Tuple[str, int, str, str]) -> Optional[paramiko.SSHClient]:
+    """Returns the cached client for a key if its connection is still up."""
+    with _ssh_lock:
+        client = _ssh_clients.get(key)
+    transport = client.get_transport() if client else None
+    if transport is not None and transport.is_active():
+        return client
+    return None
 
-        from io import StringIO
-        key_file = StringIO(creds['key'])
-        pkey = paramiko.RSAKey.from_private_key(key_file)
+def _get_ssh_client(creds: Dict[str, Any]) -> paramiko.SSHClient:
+    """Returns a connected SSH client for the credentials, connecting on first use."""
+    key = _ssh_cache_key(creds)
+    client = _cached_ssh_client(key)
+    if client is not None:
+        return client
 
+    with _ssh_key_lock(key):
+        # Another caller may have connected while we waited
+        client = _cached_ssh_client(key)
+        if client is not None:
+            return client
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        pkey = _parse_pkey(creds['key'])
         client.connect(
             hostname=creds['host'],
             port=creds['port'],
             username=creds['username'],
             pkey=pkey,
-            timeout=180
+            timeout=180,
+            banner_timeout=10
         )
+        transport = client.get_transport()
+        transport.default_window_size = _SSH_WINDOW_SIZE
+        transport.set_keepalive(_SSH_KEEPALIVE_INTERVAL)
+        with _ssh_lock:
+            _sftp_clients.pop(key, None)
+            _ssh_clients[key] = client
+        logger.info(f"Opened SSH connection to {creds['host']}:{creds['port']}")
+        return client
 
-        stdin, stdout, stderr = client.exec_command(command, timeout=180)
+def _get_sftp_client(creds: Dict[str, Any]) -> paramiko.SFTPClient:
+    """Returns an SFTP session on the cached SSH connection, opening it on first use."""
+    client = _get_ssh_client(creds)
+    key = _ssh_cache_key(creds)
+    with _ssh_key_lock(key):
+        with _ssh_lock:
+            sftp = _sftp_clients.get(key)
+        if sftp is None:
+            sftp = client.open_sftp()
+            with _ssh_lock:
+                _sftp_clients[key] = sftp
+        return sftp
 
-        stdout_str = stdout.read().decode('utf-8').strip()
-        stderr_str = stderr.read().decode('utf-8').strip()
-        returncode = stdout.channel.recv_exit_status()
+def _with_ssh_retry(creds: Dict[str, Any], operation: Callable[[], Any]) -> Any:
+    """Runs an operation on a cached connection, reconnecting once if it has gone stale."""
+    try:
+        return operation()
+    except paramiko.AuthenticationException:
+        raise
+    except (paramiko.SSHException, EOFError, ConnectionError) as e:
+        logger.warning(f"SSH connection to {creds['host']} failed ({e}), reconnecting.")
+        _drop_ssh_client(_ssh_cache_key(creds))
+        return operation()
 
-        client.close()
+def _drain_channel(
+    channel: paramiko.Channel,
+    stdout: Union[_CappedOutput, _BatchStream],
+    stderr: Union[_CappedOutput, _BatchStream],
+    timeout: float = 180
+) -> int:
+    """
+    Feeds a channel's stdout and stderr into the given sinks until EOF and
+    returns the exit status. Both streams are drained as data arrives, so a
+    command that writes a lot to stderr cannot stall stdout on the channel window.
+    """
+    while not (channel.eof_received or channel.closed) or channel.recv_ready() or channel.recv_stderr_ready():
+        if not (channel.recv_ready() or channel.recv_stderr_ready()):
+            # The channel's fileno becomes readable on stdout/stderr data and on EOF
+            readable, _, _ = select.select([channel], [], [], timeout)
+            if not readable:
+                raise socket.timeout(f"No output for {timeout} seconds.")
+        while channel.recv_ready():
+            stdout.feed(channel.recv(_SSH_RECV_SIZE))
+        while channel.recv_stderr_ready():
+            stderr.feed(channel.recv_stderr(_SSH_RECV_SIZE))
+    return channel.recv_exit_status()
 
-        return {
-            "command": command,
-            "stdout": stdout_str,
-            "stderr": stderr_str,
-            "returncode": returncode,
-        }
+def _execute_ssh(command: str, creds: Dict[str, Any], limit: int = OUTPUT_CAPTURE_BYTES) -> CommandResult:
+    """Executes a single shell command on a remote server."""
+    logger.info(f"Executing SSH command: {command} on {creds['host']}")
+
+    def run():
+        client = _get_ssh_client(creds)
+        stdin, stdout, stderr = client.exec_command(command, timeout=180)
+        stdout_output, stderr_output = _CappedOutput(limit), _CappedOutput()
+        returncode = _drain_channel(stdout.channel, stdout_output, stderr_output)
+        return stdout_output, stderr_output, returncode
+
+    try:
+        return _capped_result(command, *_with_ssh_retry(creds, run))
     except Exception as e:
         logger.error(f"Failed to execute SSH command '{command}': {e}")
-        return {"command": command, "stdout": "", "stderr": str(e), "returncode": -1}
+        return CommandResult(command, "", str(e), -1)
+
+def _execute_ssh_batch(commands: List[str], creds: Dict[str, Any]) -> List[CommandResult]:
+    """
+    Executes several shell commands on a remote server over a single channel.
+    Each command is passed quoted to its own `$SHELL -c` (the login shell that
+    runs single SSH commands), so it is parsed and run on its own as it would be
+    on a separate channel (an unbalanced quote or a syntax error only fails that
+    command), and is followed by a marker carrying its exit code so the combined
+    stdout/stderr can be split back into per-command results. If the channel
+    fails or times out, commands that already finished keep their results.
+    """
+    logger.info(f"Executing {len(commands)} SSH commands in one batch on {creds['host']}")
+    marker = f"__ARG_SEP_{secrets.token_hex(8)}__"
+    script = "\n".join(
+        f'"${{SHELL:-/bin/sh}}" -c {shlex.quote(command)}\necho "{marker}$?__"; echo "{marker}" >&2'
+        for command in commands
+    )
+    stdout_stream = stderr_stream = None
+
+    def run():
+        nonlocal stdout_stream, stderr_stream
+        # Exit codes are at most 3 digits
+        stdout_stream = _BatchStream(re.compile(rf"{marker}(\d+)__\n".encode()), len(marker) + 6)
+        stderr_stream = _BatchStream(re.compile(f"{marker}\n".encode()), len(marker) + 1)
+        client = _get_ssh_client(creds)
+        stdin, stdout, stderr = client.exec_command(script, timeout=180)
+        try:
+            _drain_channel(stdout.channel, stdout_stream, stderr_stream)
+        except BaseException:
+            # Do not leave the script running on the cached connection
+            stdout.channel.close()
+            raise
+
+    error = None
+    try:
+        _with_ssh_retry(creds, run)
+    except Exception as e:
+        logger.error(f"Failed to execute SSH batch on {creds['host']}: {e}")
+        if stdout_stream is None:
+            return [CommandResult(command, "", str(e), -1) for command in commands]
+        error = str(e)
+    stdout_stream.close()
+    stderr_stream.close()
+
+    completed = len(stdout_stream.codes)
+    results = []
+    for i, command in enumerate(commands):
+        stderr = stderr_stream.outputs[i] if i < len(stderr_stream.outputs) else _CappedOutput()
+        if i < completed:
+            stdout, returncode = stdout_stream.outputs[i], stdout_stream.codes[i]
+        elif i == completed:
+            # The batch stopped while this command was running
+            stdout, returncode = stdout_stream.outputs[i], -1
+            if error:
+                stderr.feed(f"\n{error}".encode())
+            elif not stderr.text():
+                stderr.feed(b"Remote batch ended before the command finished.")
+        else:
+            stdout, returncode = _CappedOutput(), -1
+            stderr = _CappedOutput()
+            stderr.feed(b"Command was not run: remote batch ended early.")
+        results.append(_capped_result(command, stdout, stderr, returncode))
+    return results
+
+def _write_file_ssh(path: str, content: Union[bytes, memoryview], creds: Dict[str, Any]) -> CommandResult:
+    """Writes UTF-8 encoded content to a file on a remote server over SFTP."""
+    logger.info(f"Writing to remote file: {path} on {creds['host']}")
+
+    def write():
+        sftp = _get_sftp_client(creds)
+        # putfo streams the buffer in pipelined chunks
+        sftp.putfo(BytesIO(content), path)
+
+    try:
+        _with_ssh_retry(creds, write)
+        return CommandResult(f"WRITE_FILE {path}", f"File '{path}' written successfully.", "", 0)
+    except Exception as e:
+        logger.error(f"Failed to write file over SSH '{path}': {e}")
+        return CommandResult(f"WRITE_FILE {path}", "", str(e), 1)
 
 
-def execute_command(full_command: str, ssh_creds: Dict[str, Any] = None) -> Dict[str, Any]:
+# Optional <<CONTENT / CONTENT markers around a WRITE_FILE payload. The payload is
+# group 1 when the closing marker is present and group 2 otherwise. Greedy groups
+# let the engine jump to the end and look back for the marker; a lazy (.*?) would
+# retry the suffix at every byte of the payload.
+_CONTENT_RE = re.compile(rb"\A(?:<<CONTENT\n)?(?:(.*)\nCONTENT|(.*))\Z", re.DOTALL)
+
+def _parse_write_args(args: str) -> Tuple[str, memoryview]:
+    """
+    Splits WRITE_FILE arguments into the path and the encoded content.
+    The content is returned as a view into a single encoded buffer, so
+    stripping the markers does not copy it. Raises ValueError if content is missing.
+    """
+    raw = args.encode('utf-8')
+    newline = raw.index(b"\n")
+    path = raw[:newline].decode('utf-8').strip()
+    content = memoryview(raw)[newline + 1:]
+    match = _CONTENT_RE.match(content)
+    start, end = match.span(match.lastindex)
+    return path, content[start:end]
+
+def _write_file_command(args: str, ssh_creds: Dict[str, Any] = None) -> CommandResult:
+    """Handles WRITE_FILE locally or, when ssh_creds are given, over SFTP."""
+    try:
+        path, content = _parse_write_args(args)
+    except ValueError:
+        return CommandResult(f"WRITE_FILE {args}", "", "Invalid WRITE_FILE format. Missing path or content.", 1)
+    if ssh_creds:
+        # Use SFTP to write the file over SSH
+        return _write_file_ssh(path, content, ssh_creds)
+    return _write_file(path, content)
+
+# Command type -> handler(args, ssh_creds)
+_LOCAL_HANDLERS: Dict[str, Callable[[str, Dict[str, Any]], CommandResult]] = {
+    "SHELL": lambda args, creds: _execute_shell(args),
+    "READ_FILE": lambda args, creds: _read_file(args),
+    "WRITE_FILE": _write_file_command,
+    "LIST_FILES": lambda args, creds: _list_files(args or "."),
+}
+
+_SSH_HANDLERS: Dict[str, Callable[[str, Dict[str, Any]], CommandResult]] = {
+    "SHELL": _execute_ssh,
+    "READ_FILE": lambda args, creds: _execute_ssh(f"cat {args}", creds, READ_FILE_CAPTURE_BYTES),
+    "WRITE_FILE": _write_file_command,
+    "LIST_FILES": lambda args, creds: _execute_ssh(f"ls -F {args or '.'}", creds),
+}
+
+_COMMAND_TYPES = ("SHELL", "READ_FILE", "WRITE_FILE", "LIST_FILES")
+_COMMAND_TYPE_MAX_LEN = max(len(command_type) for command_type in _COMMAND_TYPES)
+
+def _split_command(full_command: str) -> Tuple[str, str]:
+    """
+    Splits a command into its type and the remaining arguments.
+    Only a short head of the command is upper-cased and compared against the known
+    type prefixes; commands without a known type return ("", command) unsplit.
+    """
+    command = full_command.lstrip()
+    head = command[:_COMMAND_TYPE_MAX_LEN].upper()
+    for command_type in _COMMAND_TYPES:
+        size = len(command_type)
+        if head.startswith(command_type) and (len(command) == size or command[size].isspace()):
+            return command_type, command[size:].lstrip()
+    return "", command
+
+def execute_command(full_command: str, ssh_creds: Dict[str, Any] = None) -> CommandResult:
     """
     Parses and executes a command, which can be a shell command or a special command.
     If ssh_creds are provided, it will execute the command on the remote server.
     """
     if not full_command.strip():
-        return {"stdout": "", "stderr": "Empty command.", "returncode": 1}
-
-    parts = full_command.split(maxsplit=1)
-    command_type = parts[0].upper()
-    args = parts[1] if len(parts) > 1 else ""
+        return CommandResult(full_command, "", "Empty command.", 1)
 
-    if command_type == "SHELL":
+    command_type, args = _split_command(full_command)
+    handler = (_SSH_HANDLERS if ssh_creds else _LOCAL_HANDLERS).get(command_type)
+    if handler is None:
+        # Default to executing as a shell command for backward compatibility,
+        # on the remote server when one is selected
         if ssh_creds:
-            return _execute_ssh(args, ssh_creds)
-        return _execute_shell(args)
-    elif command_type == "READ_FILE":
-        if ssh_creds:
-            return _execute_ssh(f"cat {args}", ssh_creds)
-        return _read_file(args)
-    elif command_type == "WRITE_FILE":
-        if ssh_creds:
-            path, content = args.split('\n', 1)
-            path = path.strip()
-            # Strip the <<CONTENT and CONTENT markers
-            if content.startswith("<<CONTENT\n"):
-                content = content[len("<<CONTENT\n"):]
-            if content.endswith("\nCONTENT"):
-                content = content[:-len("\nCONTENT")]
-            # Use SFTP to write the file over SSH
-            try:
-                client = paramiko.SSHClient()
-                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-                from io import StringIO
-                key_file = StringIO(ssh_creds['key'])
-                pkey = paramiko.RSAKey.from_private_key(key_file)
-
-                client.connect(
-                    hostname=ssh_creds['host'],
-                    port=ssh_creds['port'],
-                    username=ssh_creds['username'],
-                    pkey=pkey,
-                    timeout=180
-                )
-                sftp = client.open_sftp()
-                with sftp.open(path, 'w') as f:
-                    f.write(content)
-                sftp.close()
-                client.close()
-                return {"command": f"WRITE_FILE {path}", "stdout": f"File '{path}' written successfully.", "stderr": "", "returncode": 0}
-            except Exception as e:
-                logger.error(f"Failed to write file over SSH '{path}': {e}")
-                return {"command": f"WRITE_FILE {path}", "stdout": "", "stderr": str(e), "returncode": 1}
-        try:
-            path, content = args.split('\n', 1)
-            path = path.strip()
-            # Strip the <<CONTENT and CONTENT markers
-            if content.startswith("<<CONTENT\n"):
-                content = content[len("<<CONTENT\n"):]
-            if content.endswith("\nCONTENT"):
-                content = content[:-len("\nCONTENT")]
-            return _write_file(path, content)
-        except ValueError:
-            return {"command": f"WRITE_FILE {args}", "stdout": "", "stderr": "Invalid WRITE_FILE format. Missing path or content.", "returncode": 1}
-    elif command_type == "LIST_FILES":
-        if ssh_creds:
-            return _execute_ssh(f"ls -F {args if args else '.'}", ssh_creds)
-        return _list_files(args if args else ".")
-    else:
-        # Default to executing as a shell command for backward compatibility
+            return _execute_ssh(full_command, ssh_creds)
         return _execute_shell(full_command)
+    return handler(args, ssh_creds)
 
-def execute_commands(commands: List[str], ssh_creds: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+def execute_commands(commands: List[str], ssh_creds: Dict[str, Any] = None, parallel: bool = False) -> List[CommandResult]:
     """
     Executes a list of commands. This is kept for the standard (non-programmer) mode.
+    With parallel=True independent commands run concurrently in a thread pool;
+    results are still returned in input order. SSH commands share the cached
+    connection, each on its own channel. A serial batch made only of shell
+    commands (SHELL or untyped) for a remote server is sent over a single
+    channel instead.
     """
+    if ssh_creds and not parallel and len(commands) > 1:
+        split = [_split_command(command) for command in commands]
+        if all(command_type in ("SHELL", "") for command_type, _ in split):
+            return _execute_ssh_batch([args for _, args in split], ssh_creds)
+
+    if parallel and len(commands) > 1:
+        with ThreadPoolExecutor(max_workers=min(32, len(commands))) as executor:
+            return list(executor.map(lambda command: execute_command(command, ssh_creds), commands))
+
     results = []
     for command in commands:
         results.append(execute_command(command, ssh_creds))
     return results
 
+async def _execute_command_async(full_command: str, ssh_creds: Dict[str, Any] = None) -> CommandResult:
+    """
+    Async counterpart of execute_command. Local shell commands run as asyncio
+    subprocesses; everything else goes through execute_command in a worker thread.
+    """
+    if ssh_creds or not full_command.strip():
+        return await asyncio.to_thread(execute_command, full_command, ssh_creds)
+    command_type, args = _split_command(full_command)
+    if command_type == "SHELL":
+        return await _execute_shell_async(args)
+    if command_type not in _LOCAL_HANDLERS:
+        return await _execute_shell_async(full_command)
+    return await asyncio.to_thread(execute_command, full_command, ssh_creds)
+
+async def execute_commands_async(
+    commands: List[str], ssh_creds: Dict[str, Any] = None, parallel: bool = False
+) -> List[CommandResult]:
+    """
+    Async counterpart of execute_commands. With parallel=True the commands run
+    concurrently via asyncio.gather; otherwise they run in order, as shell
+    commands may depend on the effects of earlier ones. Remote batches are
+    handed to execute_commands in a worker thread so they keep sharing one
+    SSH channel.
+    """
+    if ssh_creds:
+        return await asyncio.to_thread(execute_commands, commands, ssh_creds, parallel)
+    if parallel:
+        return list(await asyncio.gather(*(_execute_command_async(command) for command in commands)))
+    return [await _execute_command_async(command) for command in commands]
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     print("--- Testing Command Executor ---")
@@ -212,7 +721,7 @@ This is a test write.
 CONTENT"""
     res3 = execute_command(write_cmd)
     print(res3)
-    if res3["returncode"] == 0:
+    if res3.returncode == 0:
         with open("test_write.txt", "r") as f:
             print(f"Content of test_write.txt: {f.read()}")
         os.remove("test_write.txt")
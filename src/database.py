@@ -1,81 +1,250 @@
+import atexit
+import functools
+import json
 import sqlite3
 import logging
-from typing import List, Dict, Any, Optional
+import queue
+import threading
+import urllib.parse
+from contextlib import contextmanager
+from typing import Iterable, List, Dict, Any, Optional, Tuple
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import base64
 import os
 
 # --- Configuration ---
 DB_FILE = "agent_memory.db"
 logger = logging.getLogger(__name__)
-ENCRYPTION_KEY = os.getenv("ENCRYPTION_KEY")
-if ENCRYPTION_KEY:
-    cipher_suite = Fernet(ENCRYPTION_KEY)
+_NONCE_SIZE = 12
+
+# --- Connection Management ---
+# A single long-lived connection is shared by all writers. It runs in
+# autocommit mode (isolation_level=None) with WAL journaling, and access is
+# serialized through _conn_lock so it can be used from any thread.
+# Plain reads go through a small pool of read-only connections instead, which
+# WAL lets run concurrently with each other and with the writer.
+
+# Per-connection settings. journal_mode=WAL is persistent in the database file
+# and is set once by initialize_database.
+_CONNECTION_PRAGMAS = """
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA cache_size=-65536;
+    PRAGMA busy_timeout=3000;
+"""
+_conn: Optional[sqlite3.Connection] = None
+_conn_lock = threading.Lock()
+
+_READ_POOL_SIZE = min(4, os.cpu_count() or 1)
+_read_pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+_read_conns: List[sqlite3.Connection] = []
+_read_pool_lock = threading.Lock()
+
+# Hot statements are kept as constants so the connection's statement cache
+# (keyed by SQL text) serves them without re-preparing.
+_SQL_INSERT_PROJECT = "INSERT INTO projects (name) VALUES (?)"
+_SQL_INSERT_TASK = "INSERT INTO tasks (project_id, description, plan) VALUES (?, ?, ?)"
+# INSERT ... RETURNING needs SQLite 3.35+; older builds fall back to lastrowid
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+_SQL_INSERT_PROJECT_RETURNING = _SQL_INSERT_PROJECT + " RETURNING id"
+_SQL_INSERT_TASK_RETURNING = _SQL_INSERT_TASK + " RETURNING id"
+# json() rejects malformed logs and stores them minified
+_SQL_UPDATE_TASK_LOG = "UPDATE tasks SET execution_log = json(?), status = 'completed' WHERE id = ?"
+_SQL_INSERT_TASK_LOG_STEP = "INSERT OR REPLACE INTO task_log_steps (task_id, idx, payload) VALUES (?, ?, json(?))"
+# Folds a task's step rows, in order, into its execution_log array
+_SQL_FINALIZE_TASK_LOG = (
+    "UPDATE tasks SET status = 'completed', execution_log = ("
+    "SELECT json_group_array(json(payload)) FROM"
+    " (SELECT payload FROM task_log_steps WHERE task_id = ?1 ORDER BY idx)"
+    ") WHERE id = ?1"
+)
+_SQL_DELETE_TASK_LOG_STEPS = "DELETE FROM task_log_steps WHERE task_id = ?"
+_SQL_SELECT_PROJECT = (
+    "SELECT id, name, created_at, programmer_mode, remote_server_id FROM projects WHERE id = ? LIMIT 1"
+)
+_SQL_SELECT_PROGRAMMER_MODE = "SELECT programmer_mode FROM projects WHERE id = ?"
+_SQL_SELECT_CACHED_PLAN = (
+    "SELECT commands FROM plan_cache"
+    " WHERE project_id = ? AND task_key = ? AND created_at >= datetime('now', ?)"
+)
+_SQL_SELECT_TASK_PROJECT_ID = "SELECT project_id FROM tasks WHERE id = ?"
+
+def _get_connection() -> sqlite3.Connection:
+    """Returns the shared connection, opening it on first use. Caller must hold _conn_lock."""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(
+            DB_FILE, check_same_thread=False, isolation_level=None, cached_statements=512
+        )
+        _conn.executescript(_CONNECTION_PRAGMAS)
+    return _conn
+
+@contextmanager
+def _connection():
+    """Yields the shared connection while holding the connection lock."""
+    with _conn_lock:
+        yield _get_connection()
+
+def _open_reader() -> sqlite3.Connection:
+    """Opens a read-only connection with the shared per-connection settings."""
+    uri = f"file:{urllib.parse.quote(os.path.abspath(DB_FILE))}?mode=ro"
+    conn = sqlite3.connect(
+        uri, uri=True, check_same_thread=False, isolation_level=None, cached_statements=512
+    )
+    conn.executescript(_CONNECTION_PRAGMAS)
+    return conn
+
+@contextmanager
+def _read_connection():
+    """
+    Borrows a read-only connection from the pool, opening new ones on demand
+    up to _READ_POOL_SIZE and waiting for a free one beyond that.
+    """
+    try:
+        conn = _read_pool.get_nowait()
+    except queue.Empty:
+        conn = None
+        with _read_pool_lock:
+            if len(_read_conns) < _READ_POOL_SIZE:
+                conn = _open_reader()
+                _read_conns.append(conn)
+        if conn is None:
+            conn = _read_pool.get()
+    try:
+        yield conn
+    finally:
+        _read_pool.put(conn)
+
+def optimize_database():
+    """Runs PRAGMA optimize so the planner's statistics follow the growing tables."""
+    try:
+        with _connection() as conn:
+            conn.execute("PRAGMA optimize")
+    except sqlite3.Error as e:
+        logger.warning(f"PRAGMA optimize failed: {e}")
+
+def close_database():
+    """
+    Closes the read pool, then runs PRAGMA optimize, truncates the WAL file and
+    closes the shared connection, if it is open.
+    """
+    global _conn
+    with _read_pool_lock:
+        for reader in _read_conns:
+            reader.close()
+        _read_conns.clear()
+        _read_pool.queue.clear()
+    with _conn_lock:
+        if _conn is None:
+            return
+        try:
+            _conn.execute("PRAGMA optimize")
+            _conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            logger.warning(f"Database maintenance failed on shutdown: {e}")
+        _conn.close()
+        _conn = None
+
+atexit.register(close_database)
 
 # --- Database Initialization ---
 
 def initialize_database():
     """Initializes the database and creates tables if they don't exist."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connection() as conn:
             cursor = conn.cursor()
-            # Project table: Stores high-level goals
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS projects (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL UNIQUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    programmer_mode INTEGER DEFAULT 0
-                )
-            """)
-
-            # Add programmer_mode column to projects table if it doesn't exist
-            try:
-                cursor.execute("ALTER TABLE projects ADD COLUMN programmer_mode INTEGER DEFAULT 0")
-                conn.commit()
-                logger.info("Column 'programmer_mode' added to 'projects' table.")
-            except sqlite3.OperationalError as e:
-                if "duplicate column name" in str(e):
-                    pass  # Column already exists
-                else:
-                    raise
-
-            # Add remote_server_id column to projects table if it doesn't exist
+            # journal_mode cannot be changed inside a transaction
+            cursor.execute("PRAGMA journal_mode=WAL")
+
+            # All schema statements commit together
+            cursor.execute("BEGIN")
             try:
-                cursor.execute("ALTER TABLE projects ADD COLUMN remote_server_id INTEGER")
-                conn.commit()
-                logger.info("Column 'remote_server_id' added to 'projects' table.")
-            except sqlite3.OperationalError as e:
-                if "duplicate column name" in str(e):
-                    pass
-                else:
-                    raise
-
-            # Task table: Stores individual tasks within a project, including their history
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS tasks (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    project_id INTEGER NOT NULL,
-                    description TEXT NOT NULL,
-                    plan TEXT,
-                    execution_log TEXT,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (project_id) REFERENCES projects (id)
-                )
-            """)
-
-            # SSH Credentials table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS ssh_credentials (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL UNIQUE,
-                    host TEXT NOT NULL,
-                    port INTEGER NOT NULL,
-                    username TEXT NOT NULL,
-                    key TEXT NOT NULL
-                )
-            """)
-            conn.commit()
+                # Project table: Stores high-level goals
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS projects (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT NOT NULL UNIQUE,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        programmer_mode INTEGER DEFAULT 0
+                    )
+                """)
+
+                # Add columns introduced after the projects table was first created
+                columns = {row[1] for row in cursor.execute("PRAGMA table_info(projects)")}
+                for column, definition in (("programmer_mode", "INTEGER DEFAULT 0"), ("remote_server_id", "INTEGER")):
+                    if column not in columns:
+                        cursor.execute(f"ALTER TABLE projects ADD COLUMN {column} {definition}")
+                        logger.info(f"Column '{column}' added to 'projects' table.")
+
+                # Lookup path from a remote server to the projects that target it
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_projects_remote
+                    ON projects (remote_server_id)
+                """)
+
+                # Task table: Stores individual tasks within a project, including their history
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS tasks (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        project_id INTEGER NOT NULL,
+                        description TEXT NOT NULL,
+                        plan TEXT,
+                        execution_log TEXT CHECK (execution_log IS NULL OR json_valid(execution_log)),
+                        status TEXT DEFAULT 'pending',
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (project_id) REFERENCES projects (id)
+                    )
+                """)
+
+                # Matches get_project_history's filter and sort order
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_tasks_proj_status_created
+                    ON tasks (project_id, status, created_at)
+                """)
+
+                # Step log: One row per programmer-mode step, written as the
+                # session runs and folded into tasks.execution_log at the end
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS task_log_steps (
+                        task_id INTEGER NOT NULL,
+                        idx INTEGER NOT NULL,
+                        payload TEXT NOT NULL CHECK (json_valid(payload)),
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (task_id, idx),
+                        FOREIGN KEY (task_id) REFERENCES tasks (id)
+                    ) WITHOUT ROWID
+                """)
+
+                # SSH Credentials table
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS ssh_credentials (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT NOT NULL UNIQUE,
+                        host TEXT NOT NULL,
+                        port INTEGER NOT NULL,
+                        username TEXT NOT NULL,
+                        key TEXT NOT NULL
+                    )
+                """)
+
+                # Plan cache: Recently generated plans, keyed by normalized task text
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS plan_cache (
+                        project_id INTEGER NOT NULL,
+                        task_key TEXT NOT NULL,
+                        commands TEXT NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (project_id, task_key)
+                    )
+                """)
+                cursor.execute("COMMIT")
+            except sqlite3.Error:
+                cursor.execute("ROLLBACK")
+                raise
             logger.info("Database initialized successfully.")
     except sqlite3.Error as e:
         logger.error(f"Database error during initialization: {e}")
@@ -86,11 +255,13 @@ def initialize_database():
 def create_project(name: str) -> Optional[int]:
     """Creates a new project and returns its ID."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("INSERT INTO projects (name) VALUES (?)", (name,))
-            conn.commit()
-            project_id = cursor.lastrowid
+            if _HAS_RETURNING:
+                project_id = cursor.execute(_SQL_INSERT_PROJECT_RETURNING, (name,)).fetchone()[0]
+            else:
+                cursor.execute(_SQL_INSERT_PROJECT, (name,))
+                project_id = cursor.lastrowid
             logger.info(f"Created project '{name}' with ID {project_id}.")
             return project_id
     except sqlite3.IntegrityError:
@@ -103,9 +274,9 @@ def create_project(name: str) -> Optional[int]:
 def list_projects() -> List[Dict[str, Any]]:
     """Lists all projects."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _read_connection() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
             cursor.execute("SELECT id, name, created_at, programmer_mode FROM projects ORDER BY created_at DESC")
             projects = [dict(row) for row in cursor.fetchall()]
             return projects
@@ -113,31 +284,70 @@ def list_projects() -> List[Dict[str, Any]]:
         logger.error(f"Failed to list projects: {e}")
         return []
 
-def set_programmer_mode(project_id: int, enabled: bool):
-    """Enables or disables programmer mode for a project."""
+def get_project(project_id: int) -> Optional[Dict[str, Any]]:
+    """Retrieves a single project by its ID."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _read_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE projects SET programmer_mode = ? WHERE id = ?",
-                (1 if enabled else 0, project_id)
-            )
-            conn.commit()
-            logger.info(f"Programmer mode for project {project_id} set to {enabled}.")
+            cursor.row_factory = sqlite3.Row
+            cursor.execute(_SQL_SELECT_PROJECT, (project_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
     except sqlite3.Error as e:
-        logger.error(f"Failed to set programmer mode for project {project_id}: {e}")
+        logger.error(f"Failed to get project {project_id}: {e}")
+        return None
+
+def update_project_settings(
+    project_id: int,
+    *,
+    programmer_mode: Optional[bool] = None,
+    remote_server_id: Optional[int] = None
+):
+    """
+    Updates project settings in a single statement.
+    Only the settings that are not None are written.
+    """
+    assignments = []
+    params: List[Any] = []
+    if programmer_mode is not None:
+        assignments.append("programmer_mode = ?")
+        params.append(1 if programmer_mode else 0)
+    if remote_server_id is not None:
+        assignments.append("remote_server_id = ?")
+        params.append(remote_server_id)
+    if not assignments:
+        return
+    params.append(project_id)
+    try:
+        with _connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"UPDATE projects SET {', '.join(assignments)} WHERE id = ?", params)
+            if programmer_mode is not None:
+                _lookup_programmer_mode.cache_clear()
+            logger.info(f"Updated settings for project {project_id}: {', '.join(assignments)}.")
+    except sqlite3.Error as e:
+        logger.error(f"Failed to update settings for project {project_id}: {e}")
+
+def set_programmer_mode(project_id: int, enabled: bool):
+    """Enables or disables programmer mode for a project."""
+    update_project_settings(project_id, programmer_mode=enabled)
+
 
+@functools.lru_cache(maxsize=512)
+def _lookup_programmer_mode(project_id: int) -> bool:
+    """Reads programmer_mode from the database. Errors propagate so they are never cached."""
+    with _connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(_SQL_SELECT_PROGRAMMER_MODE, (project_id,))
+        result = cursor.fetchone()
+        if result:
+            return bool(result[0])
+        return False
 
 def is_programmer_mode_enabled(project_id: int) -> bool:
     """Checks if programmer mode is enabled for a project."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT programmer_mode FROM projects WHERE id = ?", (project_id,))
-            result = cursor.fetchone()
-            if result:
-                return bool(result[0])
-            return False
+        return _lookup_programmer_mode(project_id)
     except sqlite3.Error as e:
         logger.error(f"Failed to check programmer mode for project {project_id}: {e}")
         return False
@@ -145,42 +355,58 @@ def is_programmer_mode_enabled(project_id: int) -> bool:
 
 def set_project_remote_server(project_id: int, credential_id: int):
     """Associates a remote server with a project."""
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE projects SET remote_server_id = ? WHERE id = ?",
-                (credential_id, project_id)
-            )
-            conn.commit()
-            logger.info(f"Project {project_id} associated with remote server {credential_id}.")
-    except sqlite3.Error as e:
-        logger.error(f"Failed to associate remote server with project {project_id}: {e}")
+    update_project_settings(project_id, remote_server_id=credential_id)
 
 # --- Task Management ---
 
 def create_task(project_id: int, description: str, plan: str) -> Optional[int]:
     """Creates a new task within a project and returns its ID."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connection() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO tasks (project_id, description, plan) VALUES (?, ?, ?)",
-                (project_id, description, plan)
-            )
-            conn.commit()
-            task_id = cursor.lastrowid
+            if _HAS_RETURNING:
+                task_id = cursor.execute(_SQL_INSERT_TASK_RETURNING, (project_id, description, plan)).fetchone()[0]
+            else:
+                cursor.execute(_SQL_INSERT_TASK, (project_id, description, plan))
+                task_id = cursor.lastrowid
             logger.info(f"Created task for project {project_id} with ID {task_id}.")
             return task_id
     except sqlite3.Error as e:
         logger.error(f"Failed to create task for project {project_id}: {e}")
         return None
 
-def get_project_history(project_id: int) -> List[Dict[str, Any]]:
-    """Retrieves the history of all completed tasks for a given project."""
+def create_tasks(project_id: int, rows: Iterable[Tuple[str, str]]) -> List[int]:
+    """Creates several tasks in a single transaction and returns their IDs in order."""
+    params = [(project_id, description, plan) for description, plan in rows]
+    if not params:
+        return []
+    try:
+        with _connection() as conn:
+            cursor = conn.cursor()
+            # IMMEDIATE takes the write lock up front, so the AUTOINCREMENT ids
+            # handed out inside this transaction are contiguous.
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                cursor.executemany(_SQL_INSERT_TASK, params)
+                last_id = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+                cursor.execute("COMMIT")
+            except sqlite3.Error:
+                cursor.execute("ROLLBACK")
+                raise
+            task_ids = list(range(last_id - len(params) + 1, last_id + 1))
+            logger.info(f"Created {len(task_ids)} tasks for project {project_id}.")
+            return task_ids
+    except sqlite3.Error as e:
+        logger.error(f"Failed to create tasks for project {project_id}: {e}")
+        return []
+
+def get_project_history(project_id: int) -> List[Tuple[str, str, str, str]]:
+    """
+    Retrieves the history of all completed tasks for a given project
+    as (description, plan, execution_log, status) tuples.
+    """
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _read_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT description, plan, execution_log, status
@@ -188,8 +414,7 @@ def get_project_history(project_id: int) -> List[Dict[str, Any]]:
                 WHERE project_id = ? AND status = 'completed'
                 ORDER BY created_at ASC
             """, (project_id,))
-            history = [dict(row) for row in cursor.fetchall()]
-            return history
+            return cursor.fetchall()
     except sqlite3.Error as e:
         logger.error(f"Failed to get history for project {project_id}: {e}")
         return []
@@ -197,9 +422,9 @@ def get_project_history(project_id: int) -> List[Dict[str, Any]]:
 def get_project_id_from_task(task_id: int) -> Optional[int]:
     """Retrieves the project ID for a given task ID."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _read_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT project_id FROM tasks WHERE id = ?", (task_id,))
+            cursor.execute(_SQL_SELECT_TASK_PROJECT_ID, (task_id,))
             result = cursor.fetchone()
             if result:
                 return result[0]
@@ -209,44 +434,134 @@ def get_project_id_from_task(task_id: int) -> Optional[int]:
         return None
 
 def update_task_log(task_id: int, execution_log: str):
-    """Updates a task with the execution log and marks it as completed."""
+    """Updates a task with the execution log (a JSON document) and marks it as completed."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connection() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE tasks SET execution_log = ?, status = 'completed' WHERE id = ?",
-                (execution_log, task_id)
-            )
-            conn.commit()
+            cursor.execute(_SQL_UPDATE_TASK_LOG, (execution_log, task_id))
             logger.info(f"Updated log for task {task_id}.")
     except sqlite3.Error as e:
         logger.error(f"Failed to update log for task {task_id}: {e}")
 
+def append_task_log_step(task_id: int, step_index: int, payload: str):
+    """
+    Stores one step's result (a JSON document) as soon as it is known, so a
+    session's log survives the process dying before the session ends.
+    """
+    try:
+        with _connection() as conn:
+            conn.execute(_SQL_INSERT_TASK_LOG_STEP, (task_id, step_index, payload))
+    except sqlite3.Error as e:
+        logger.error(f"Failed to append log step {step_index} for task {task_id}: {e}")
+
+def get_task_log_steps(task_id: int) -> List[str]:
+    """Returns the step payloads recorded for a task, in step order."""
+    try:
+        with _read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT payload FROM task_log_steps WHERE task_id = ? ORDER BY idx", (task_id,))
+            return [row[0] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Failed to get log steps for task {task_id}: {e}")
+        return []
+
+def finalize_task_log(task_id: int):
+    """
+    Marks a task as completed with its step rows collected into the execution
+    log array, then drops the rows, in one transaction.
+    """
+    try:
+        with _connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                cursor.execute(_SQL_FINALIZE_TASK_LOG, (task_id,))
+                cursor.execute(_SQL_DELETE_TASK_LOG_STEPS, (task_id,))
+                cursor.execute("COMMIT")
+            except sqlite3.Error:
+                cursor.execute("ROLLBACK")
+                raise
+            logger.info(f"Finalized log for task {task_id}.")
+    except sqlite3.Error as e:
+        logger.error(f"Failed to finalize log for task {task_id}: {e}")
+
+# --- Plan Cache ---
+
+def get_cached_plan(project_id: int, task_key: str, max_age: int = 3600) -> Optional[str]:
+    """Returns a plan cached for the task within the last `max_age` seconds, if any."""
+    try:
+        with _read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                _SQL_SELECT_CACHED_PLAN, (project_id, task_key, f"-{max_age} seconds")
+            )
+            result = cursor.fetchone()
+            return result[0] if result else None
+    except sqlite3.Error as e:
+        logger.error(f"Failed to read cached plan for project {project_id}: {e}")
+        return None
+
+def cache_plan(project_id: int, task_key: str, commands: str):
+    """Stores (or refreshes) the plan generated for a task."""
+    try:
+        with _connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO plan_cache (project_id, task_key, commands) VALUES (?, ?, ?)",
+                (project_id, task_key, commands)
+            )
+    except sqlite3.Error as e:
+        logger.error(f"Failed to cache plan for project {project_id}: {e}")
+
+def prune_plan_cache(max_age: int = 3600) -> int:
+    """Deletes cached plans older than `max_age` seconds and returns how many were removed."""
+    try:
+        with _connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM plan_cache WHERE created_at < datetime('now', ?)", (f"-{max_age} seconds",))
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        logger.error(f"Failed to prune plan cache: {e}")
+        return 0
+
 # --- SSH Credential Management ---
 
-def _encrypt(text: str) -> bytes:
-    """Encrypts a string."""
-    if not ENCRYPTION_KEY:
+@functools.lru_cache(maxsize=1)
+def _ciphers() -> Tuple[AESGCM, Fernet]:
+    """
+    Builds the ciphers from ENCRYPTION_KEY on first use, so the key may come
+    from a .env file loaded after this module is imported.
+    """
+    encryption_key = os.getenv("ENCRYPTION_KEY")
+    if not encryption_key:
         raise ValueError("ENCRYPTION_KEY not set.")
-    return cipher_suite.encrypt(text.encode())
+    # Fernet is only kept to read credentials stored before the switch to AES-GCM.
+    return AESGCM(base64.urlsafe_b64decode(encryption_key)[:32]), Fernet(encryption_key)
+
+def _encrypt(text: str) -> bytes:
+    """Encrypts a string with AES-GCM, returning nonce + ciphertext."""
+    aead, _ = _ciphers()
+    nonce = os.urandom(_NONCE_SIZE)
+    return nonce + aead.encrypt(nonce, text.encode(), None)
 
 def _decrypt(encrypted_text: bytes) -> str:
-    """Decrypts a string."""
-    if not ENCRYPTION_KEY:
-        raise ValueError("ENCRYPTION_KEY not set.")
-    return cipher_suite.decrypt(encrypted_text).decode()
+    """Decrypts a string, falling back to Fernet for legacy rows."""
+    aead, cipher_suite = _ciphers()
+    try:
+        return aead.decrypt(encrypted_text[:_NONCE_SIZE], encrypted_text[_NONCE_SIZE:], None).decode()
+    except InvalidTag:
+        return cipher_suite.decrypt(encrypted_text).decode()
 
 def add_ssh_credential(name: str, host: str, port: int, username: str, key: str) -> Optional[int]:
     """Adds new SSH credentials to the database."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connection() as conn:
             cursor = conn.cursor()
             encrypted_key = _encrypt(key)
             cursor.execute(
                 "INSERT INTO ssh_credentials (name, host, port, username, key) VALUES (?, ?, ?, ?, ?)",
                 (name, host, port, username, encrypted_key)
             )
-            conn.commit()
             cred_id = cursor.lastrowid
             logger.info(f"Added SSH credential '{name}' with ID {cred_id}.")
             return cred_id
@@ -260,9 +575,9 @@ def add_ssh_credential(name: str, host: str, port: int, username: str, key: str)
 def list_ssh_credentials() -> List[Dict[str, Any]]:
     """Lists all SSH credentials."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _read_connection() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
             cursor.execute("SELECT id, name, host, port, username FROM ssh_credentials ORDER BY name")
             credentials = [dict(row) for row in cursor.fetchall()]
             return credentials
@@ -273,9 +588,9 @@ def list_ssh_credentials() -> List[Dict[str, Any]]:
 def get_ssh_credential(credential_id: int) -> Optional[Dict[str, Any]]:
     """Retrieves a single SSH credential by its ID."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _read_connection() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
             cursor.execute("SELECT * FROM ssh_credentials WHERE id = ?", (credential_id,))
             credential = dict(cursor.fetchone())
             credential['key'] = _decrypt(credential['key'])
@@ -309,7 +624,7 @@ if __name__ == '__main__':
         task_id = create_task(pid, "Install nginx", "apt-get update\napt-get install nginx -y")
         if task_id:
             print(f"Task created with ID: {task_id}")
-            log_data = "[{'command': 'apt-get update', 'returncode': 0, 'stdout': '...', 'stderr': ''}]"
+            log_data = json.dumps([{'command': 'apt-get update', 'returncode': 0, 'stdout': '...', 'stderr': ''}])
             update_task_log(task_id, log_data)
             print("Task log updated.")
 
@@ -1,108 +1,278 @@
 import os
+import asyncio
+import datetime
+import functools
+import hashlib
+import textwrap
+from collections import OrderedDict
+from dataclasses import dataclass
 import google.generativeai as genai
+from google.generativeai import caching
 import logging
-from typing import List, Dict, Any, Optional
+from typing import Any, Awaitable, Callable, List, Tuple, Optional
 
 logger = logging.getLogger(__name__)
 
+# Number of prompt -> response pairs kept in memory per client
+PROMPT_CACHE_SIZE = 256
+
+# Lifetime of the server-side context cache created for a programmer session
+SESSION_CACHE_TTL = datetime.timedelta(minutes=30)
+
+# Prompt templates are dedented once at import and filled in with str.format
+_STANDARD_PROMPT = textwrap.dedent("""
+    You are an expert system administrator. Your task is to convert a user's request into a series of executable shell commands for a Linux server.
+    The user is running as the root user, so you do not need to use 'sudo'.
+    Provide only the shell commands, one per line, without any additional explanations, comments, or formatting like ```bash.
+
+    If the user asks a question about the server's status, provide the necessary commands to answer it. For example, to check CPU usage, you could use `top -bn1 | grep "Cpu(s)"`. To check memory, use `free -h`. For disk space, use `df -h`.
+
+    {history_context}
+    Current user request: "{task_description}"
+
+    Commands:
+""")
+
+_OUTPUT_CONTEXT = textwrap.dedent("""
+    The last command produced the following output. Use this to decide the next step.
+    <last_command_output>
+    {last_command_output}
+    </last_command_output>
+""")
+
+_PROGRAMMER_PROMPT = textwrap.dedent("""
+    You are an autonomous AI programmer and system administrator. Your goal is to complete the user's task by executing a sequence of commands.
+    You operate in a loop: you issue a command, observe the output, and then decide on the next command.
+
+    **Important:** You may be working on a local machine or a remote server via SSH. Be mindful of this when formulating commands.
+
+    **Available Commands:**
+    1. `SHELL <command>`: Executes a shell command on the Linux server (as root).
+    2. `READ_FILE <path>`: Reads the content of a file at the given path.
+    3. `WRITE_FILE <path>`: Writes content to a file. The content must be enclosed in a '<<CONTENT' and 'CONTENT' block on new lines.
+       Example:
+       WRITE_FILE /etc/nginx/nginx.conf
+       <<CONTENT
+       user www-data;
+       worker_processes auto;
+       CONTENT
+    4. `LIST_FILES <path>`: Lists the files in a directory.
+    5. `TASK_COMPLETE`: Issue this command when you are certain the task is fully completed.
+
+    **Your Process:**
+    1. **Analyze the Goal:** Understand the user's request: "{task_description}".
+    2. **Consult History:** Review the project history: {history_context}
+    3. **Observe Output:** Use the output from the previous command to guide your next action: {output_context}
+    4. **Formulate Next Command:** Decide on the single best command to execute next to get closer to the goal.
+    5. **Repeat:** Continue this loop until the task is complete.
+
+    **Instructions:**
+    - Think step-by-step.
+    - **Error Handling:** Pay close attention to the command output. A `returncode` other than 0, or any output in `stderr`, indicates an error. If a command fails, analyze the error and try to fix it. For example, if a package fails to install, you might need to update package lists first. If a file is not found, you might need to create it or check the path.
+    - Only output the *next single command* to be executed. Do not provide explanations or comments.
+    - If you need to write a file, make sure the content is correct and complete.
+    - Long output, including READ_FILE output, may be cut in the middle; the cut is marked with `... [N bytes omitted] ...`. Never write such output back with WRITE_FILE. Edit large files with targeted commands (e.g. `sed -i`) instead.
+
+    Based on the current state, what is the next command you will issue?
+
+    Command:
+""")
+
+def _format_history(
+    history: Optional[List[Tuple[str, str, str, str]]],
+    header: str = "Here is the history of previous tasks for this project:\n"
+) -> str:
+    """Renders (description, plan, execution_log, status) tuples into the prompt's history section."""
+    if not history:
+        return ""
+    parts = [header]
+    parts.extend(
+        f"- Task: {description}\n  - Plan: {plan}\n  - Outcome: {status} (Log: {execution_log})\n"
+        for description, plan, execution_log, status in history
+    )
+    parts.append("\n")
+    return "".join(parts)
+
+@functools.lru_cache(maxsize=1)
+def _shared_model(api_key: str, model_name: str) -> genai.GenerativeModel:
+    """
+    Configures the SDK and builds the model once per process, so every client
+    reuses the same pooled gRPC channel instead of reconnecting.
+    """
+    genai.configure(api_key=api_key, transport="grpc")
+    return genai.GenerativeModel(model_name)
+
+_SUMMARY_PROMPT = textwrap.dedent("""
+    Summarize the following steps of an automated system administration session.
+    Keep every fact needed to continue the work: commands that succeeded, errors and their causes, files changed, and the current state.
+    Be concise and answer with the summary only.
+
+    {history_context}
+""")
+
+# Per-step prompt sent on top of a session's cached context
+_SESSION_STEP_PROMPT = textwrap.dedent("""
+    {session_steps}
+    {output_context}
+    Based on the current state, what is the next command you will issue?
+
+    Command:
+""")
+
+@dataclass(slots=True)
+class CachedSession:
+    """A programmer session whose static prompt is held in Gemini's context cache."""
+    cache: Any
+    model: genai.GenerativeModel
+
 class GeminiClient:
     def __init__(self, api_key):
         if not api_key:
             raise ValueError("API key for Google Gemini is not provided.")
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-flash-latest')
+        self.model = _shared_model(api_key, 'gemini-flash-latest')
+        # LRU of responses keyed by a digest of the full prompt. The client is
+        # only used from the event loop, so the cache needs no locking.
+        self._cache: "OrderedDict[bytes, str]" = OrderedDict()
+
+    def _cache_get(self, key: bytes) -> Optional[str]:
+        commands = self._cache.get(key)
+        if commands is not None:
+            self._cache.move_to_end(key)
+        return commands
 
-    def get_commands(
+    def _cache_put(self, key: bytes, commands: str):
+        self._cache[key] = commands
+        self._cache.move_to_end(key)
+        if len(self._cache) > PROMPT_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    async def get_commands(
         self,
         task_description: str,
-        history: List[Dict[str, Any]],
-        is_programmer_mode: bool,
-        last_command_output: Optional[str] = None
+        history: Optional[List[Tuple[str, str, str, str]]] = None,
+        is_programmer_mode: bool = False,
+        last_command_output: Optional[str] = None,
+        on_chunk: Optional[Callable[[str], Awaitable[None]]] = None,
+        use_cache: bool = True
     ) -> str:
         """
         Generates a sequence of commands based on the task, history, and mode.
+        History entries are (description, plan, execution_log, status) tuples.
+        The response is streamed; if on_chunk is given it is awaited with the
+        text accumulated so far each time a chunk arrives. With use_cache=False
+        the prompt cache is neither read nor updated.
         """
-        history_context = ""
-        if history:
-            history_context += "Here is the history of previous tasks for this project:\n"
-            for task in history:
-                history_context += f"- Task: {task['description']}\n"
-                history_context += f"  - Plan: {task['plan']}\n"
-                history_context += f"  - Outcome: {task['status']} (Log: {task['execution_log']})\n"
-            history_context += "\n"
+        history_context = _format_history(history)
 
         if is_programmer_mode:
             prompt = self._get_programmer_mode_prompt(task_description, history_context, last_command_output)
         else:
             prompt = self._get_standard_mode_prompt(task_description, history_context)
 
+        key = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+        cached = self._cache_get(key) if use_cache else None
+        if cached is not None:
+            logger.info(f"Using cached commands for task: '{task_description}'")
+            if on_chunk:
+                await on_chunk(cached)
+            return cached
+
+        logger.info(f"Generating commands for task: '{task_description}'")
+        commands = await self._generate(self.model, prompt, on_chunk)
+        # Empty responses are not cached so the next attempt asks again
+        if use_cache and commands:
+            self._cache_put(key, commands)
+        return commands
+
+    async def summarize_history(self, history: List[Tuple[str, str, str, str]]) -> str:
+        """Condenses history entries into a short summary. Returns "" on error."""
+        prompt = _SUMMARY_PROMPT.format(history_context=_format_history(history, header=""))
+        logger.info(f"Summarizing {len(history)} history entries.")
+        return await self._generate(self.model, prompt)
+
+    async def create_cached_content(
+        self, task_description: str, history: Optional[List[Tuple[str, str, str, str]]] = None
+    ) -> Optional[CachedSession]:
+        """
+        Uploads the programmer-mode prompt for a task, with the project history,
+        to Gemini's context cache so later steps only send what changed.
+        Returns None when caching is unavailable (e.g. the prompt is below the
+        model's minimum cacheable size); callers then fall back to get_commands.
+        """
+        contents = self._get_programmer_mode_prompt(task_description, _format_history(history), None)
         try:
-            logger.info(f"Generating commands for task: '{task_description}'")
-            response = self.model.generate_content(prompt)
-            commands = response.text.strip()
-            logger.info(f"Successfully generated commands:\n{commands}")
-            return commands
+            cache = await asyncio.to_thread(
+                caching.CachedContent.create,
+                model=self.model.model_name, contents=[contents], ttl=SESSION_CACHE_TTL
+            )
+            model = genai.GenerativeModel.from_cached_content(cached_content=cache)
         except Exception as e:
-            logger.error(f"An error occurred while communicating with Gemini API: {e}")
-            return ""
+            logger.info(f"Context caching unavailable, sending full prompts instead: {e}")
+            return None
+        logger.info(f"Created context cache {cache.name} ({cache.usage_metadata.total_token_count} tokens).")
+        return CachedSession(cache, model)
 
-    def _get_standard_mode_prompt(self, task_description: str, history_context: str) -> str:
-        return f"""
-        You are an expert system administrator. Your task is to convert a user's request into a series of executable shell commands for a Linux server.
-        The user is running as the root user, so you do not need to use 'sudo'.
-        Provide only the shell commands, one per line, without any additional explanations, comments, or formatting like ```bash.
+    async def generate_with_cache(
+        self,
+        session: CachedSession,
+        steps: List[Tuple[str, str, str, str]],
+        last_command_output: Optional[str] = None
+    ) -> str:
+        """Asks for the next command of a cached session, sending only this session's steps and the last output."""
+        output_context = ""
+        if last_command_output is not None:
+            output_context = _OUTPUT_CONTEXT.format(last_command_output=last_command_output)
+        session_steps = _format_history(steps, header="Steps taken so far in this session:\n")
+        prompt = _SESSION_STEP_PROMPT.format(session_steps=session_steps, output_context=output_context)
+        return await self._generate(session.model, prompt)
 
-        If the user asks a question about the server's status, provide the necessary commands to answer it. For example, to check CPU usage, you could use `top -bn1 | grep "Cpu(s)"`. To check memory, use `free -h`. For disk space, use `df -h`.
+    async def delete_cached_content(self, session: CachedSession):
+        """Drops a session's context cache before its TTL runs out."""
+        try:
+            await asyncio.to_thread(session.cache.delete)
+        except Exception as e:
+            logger.warning(f"Failed to delete context cache {session.cache.name}: {e}")
+
+    async def _generate(
+        self,
+        model: genai.GenerativeModel,
+        prompt: str,
+        on_chunk: Optional[Callable[[str], Awaitable[None]]] = None
+    ) -> str:
+        """Streams a response from `model`, returning the stripped text or "" on error."""
+        try:
+            response = await model.generate_content_async(prompt, stream=True)
+            parts = []
+            async for chunk in response:
+                # The closing and usage-only chunks carry no parts, and .text
+                # raises on them
+                if not chunk.parts:
+                    continue
+                parts.append(chunk.text)
+                if on_chunk:
+                    await on_chunk("".join(parts))
+        except Exception as e:
+            logger.error(f"An error occurred while communicating with Gemini API: {e}")
+            return ""
 
-        {history_context}
-        Current user request: "{task_description}"
+        commands = "".join(parts).strip()
+        # Usage is informational only; a missing field must not cost the response
+        try:
+            usage = response.usage_metadata
+            tokens = f"{usage.prompt_token_count} prompt tokens, {usage.cached_content_token_count} cached"
+        except Exception:
+            tokens = "token usage unavailable"
+        logger.info(f"Successfully generated commands ({tokens}):\n{commands}")
+        return commands
 
-        Commands:
-        """
+    def _get_standard_mode_prompt(self, task_description: str, history_context: str) -> str:
+        return _STANDARD_PROMPT.format(history_context=history_context, task_description=task_description)
 
     def _get_programmer_mode_prompt(self, task_description: str, history_context: str, last_command_output: Optional[str]) -> str:
         output_context = ""
         if last_command_output is not None:
-            output_context = f"""
-            The last command produced the following output. Use this to decide the next step.
-            <last_command_output>
-            {last_command_output}
-            </last_command_output>
-            """
-
-        return f"""
-        You are an autonomous AI programmer and system administrator. Your goal is to complete the user's task by executing a sequence of commands.
-        You operate in a loop: you issue a command, observe the output, and then decide on the next command.
-
-        **Important:** You may be working on a local machine or a remote server via SSH. Be mindful of this when formulating commands.
-
-        **Available Commands:**
-        1. `SHELL <command>`: Executes a shell command on the Linux server (as root).
-        2. `READ_FILE <path>`: Reads the content of a file at the given path.
-        3. `WRITE_FILE <path>`: Writes content to a file. The content must be enclosed in a '<<CONTENT' and 'CONTENT' block on new lines.
-           Example:
-           WRITE_FILE /etc/nginx/nginx.conf
-           <<CONTENT
-           user www-data;
-           worker_processes auto;
-           CONTENT
-        4. `LIST_FILES <path>`: Lists the files in a directory.
-        5. `TASK_COMPLETE`: Issue this command when you are certain the task is fully completed.
-
-        **Your Process:**
-        1. **Analyze the Goal:** Understand the user's request: "{task_description}".
-        2. **Consult History:** Review the project history: {history_context}
-        3. **Observe Output:** Use the output from the previous command to guide your next action: {output_context}
-        4. **Formulate Next Command:** Decide on the single best command to execute next to get closer to the goal.
-        5. **Repeat:** Continue this loop until the task is complete.
-
-        **Instructions:**
-        - Think step-by-step.
-        - **Error Handling:** Pay close attention to the command output. A `returncode` other than 0, or any output in `stderr`, indicates an error. If a command fails, analyze the error and try to fix it. For example, if a package fails to install, you might need to update package lists first. If a file is not found, you might need to create it or check the path.
-        - Only output the *next single command* to be executed. Do not provide explanations or comments.
-        - If you need to write a file, make sure the content is correct and complete.
-
-        Based on the current state, what is the next command you will issue?
-
-        Command:
-        """
\ No newline at end of file
+            output_context = _OUTPUT_CONTEXT.format(last_command_output=last_command_output)
+
+        return _PROGRAMMER_PROMPT.format(
+            task_description=task_description, history_context=history_context, output_context=output_context
+        )
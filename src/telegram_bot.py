@@ -1,14 +1,21 @@
 import asyncio
 import logging
 import os
+import re
 import json
+import time
+from collections import deque
+from dataclasses import asdict
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+from telegram.helpers import escape_markdown
+from telegram.ext import AIORateLimiter, Application, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 
 # Import our custom modules
 from gemini_client import GeminiClient
-from command_executor import execute_command, execute_commands
+from command_executor import CommandResult, execute_command, execute_commands_async
 import database as db
 
 # --- Configuration ---
@@ -17,12 +24,170 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Load environment variables from .env file
-load_dotenv(dotenv_path='src/.env')
-
-# Load credentials from environment variables
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# Matches each non-blank line of a plan, starting at its first non-space character
+_NON_EMPTY_LINE = re.compile(r"\S.*")
+
+# Including this directive in a task bypasses the plan cache
+PLAN_CACHE_DIRECTIVE = "#nocache"
+# Seconds a generated plan stays reusable for the same task in a project
+PLAN_CACHE_TTL = 3600
+
+# History entries kept in a programmer session's prompt. Entries that do not
+# fit are folded into a single summary entry rather than dropped.
+SESSION_HISTORY_SIZE = 8
+
+# Step reports longer than this get their own message instead of being folded
+# into the programmer-mode status message
+STEP_REPORT_MESSAGE_THRESHOLD = 1024
+
+# Seconds between PRAGMA optimize runs while the bot is up
+DB_OPTIMIZE_INTERVAL = 15 * 60
+
+# Telegram's message length limit. It counts characters, not UTF-8 bytes.
+_MESSAGE_LIMIT = 4096
+_TRUNCATION_MARKER = "\n... (отчет был обрезан)"
+_CODE_FENCE_OPEN, _CODE_FENCE_CLOSE = "\n```\n", "\n```"
+
+# Plan confirmation buttons. Callback data is kept short: "c_<task_id>" or "x_<task_id>".
+_CONFIRM_LABEL, _CANCEL_LABEL = "✅ Выполнить", "❌ Отклонить"
+# Parses that callback data into (action, task_id)
+_CB_RE = re.compile(r"^(c|x)_(\d+)$")
+
+# Execution logs are stored compactly; they are only read back by the model
+_LOG_ENCODER = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+# Minimum interval between edits of a message that previews a streamed plan
+STREAM_EDIT_INTERVAL = 0.5
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates from different chats concurrently and updates from the
+    same chat one at a time, in the order they arrived. Handlers that change
+    per-chat state (selected project, mode, SSH server) therefore finish before
+    a later task from that chat reads it.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # chat_id -> [lock, number of updates holding or waiting for it]
+        self._chats: Dict[int, list] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            await coroutine
+            return
+        entry = self._chats.get(chat.id)
+        if entry is None:
+            entry = self._chats[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+def _enqueue_chat_job(context: ContextTypes.DEFAULT_TYPE, chat_id: int, job: Callable[[], Awaitable[None]]) -> None:
+    """
+    Queues `job` behind earlier work for the same chat. Each chat with pending
+    work has one worker task, so jobs run in order within a chat while slow
+    jobs in one chat never hold up another.
+    """
+    workers = context.bot_data["chat_workers"]
+    queue = workers.get(chat_id)
+    if queue is None:
+        queue = asyncio.Queue()
+        workers[chat_id] = queue
+        context.application.create_task(_chat_worker(workers, chat_id, queue))
+    queue.put_nowait(job)
+
+async def _chat_worker(workers: Dict[int, asyncio.Queue], chat_id: int, queue: asyncio.Queue) -> None:
+    """Runs queued jobs for a chat one by one and exits once the queue is drained."""
+    while True:
+        try:
+            job = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            # No await between the check and the removal, so nothing can be
+            # queued for this worker after it decides to stop.
+            del workers[chat_id]
+            return
+        try:
+            await job()
+        except Exception as e:
+            logger.error(f"A queued job failed for chat {chat_id}: {e}")
+
+def plan_markup(task_id: int) -> InlineKeyboardMarkup:
+    """Builds the confirm/cancel keyboard for a proposed plan."""
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(_CONFIRM_LABEL, callback_data=f"c_{task_id}"),
+        InlineKeyboardButton(_CANCEL_LABEL, callback_data=f"x_{task_id}"),
+    ]])
+
+def _cut_escaped(text: str, size: int) -> str:
+    """Cuts escaped MarkdownV2 text to at most `size` characters without splitting an escape."""
+    text = text[:size]
+    if (len(text) - len(text.rstrip("\\"))) % 2:
+        text = text[:-1]
+    return text
+
+def _join_markdown(fragments: Iterable[Tuple[str, bool]], limit: int = _MESSAGE_LIMIT) -> str:
+    """
+    Joins escaped MarkdownV2 fragments, given as (text, is_code_block_body)
+    pairs, into a message of at most `limit` characters. If the message has to
+    be cut, a code block left open is closed before the cut is marked, so
+    Telegram can still parse it. Fragments past the cut are never copied.
+    """
+    marker = escape_markdown(_TRUNCATION_MARKER, version=2)
+    room = limit - len(_CODE_FENCE_CLOSE) - len(marker)
+    parts = []
+    inside_block = False
+    for text, is_code in fragments:
+        if len(text) <= room:
+            parts.append(text)
+            room -= len(text)
+            inside_block = is_code
+            continue
+        if is_code:
+            parts.append(_cut_escaped(text, room))
+        if is_code or inside_block:
+            parts.append(_CODE_FENCE_CLOSE)
+        parts.append(marker)
+        break
+    return "".join(parts)
+
+def _code_message(header: str, code: str, limit: int = _MESSAGE_LIMIT) -> str:
+    """
+    Formats `header` followed by `code` in a fenced block as MarkdownV2, with
+    both parts escaped. The code is cut short to keep the message within `limit`.
+    """
+    head = escape_markdown(header, version=2) + _CODE_FENCE_OPEN
+    tail = _CODE_FENCE_CLOSE
+    body = escape_markdown(code, version=2, entity_type='pre')
+    room = limit - len(head) - len(tail)
+    if len(body) > room:
+        body = _cut_escaped(body, room - len(_TRUNCATION_MARKER)) + _TRUNCATION_MARKER
+    return head + body + tail
+
+def _with_report(report: str, status: str) -> str:
+    """
+    Puts the previous step's short report above a MarkdownV2 status text, so
+    the next status edit does not hide it. The report is left out if the two
+    would not fit in one message.
+    """
+    combined = f"{report}\n\n{status}" if report else status
+    return combined if len(combined) <= _MESSAGE_LIMIT else status
+
+async def _db(fn, *args):
+    """Runs a blocking database helper in a worker thread so the event loop stays responsive."""
+    return await asyncio.to_thread(fn, *args)
 
 # --- Bot Handlers ---
 
@@ -50,7 +215,7 @@ async def new_project(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await update.message.reply_text("Пожалуйста, укажите название проекта. Пример: /new_project Установка веб-сервера")
         return
 
-    project_id = db.create_project(project_name)
+    project_id = await _db(db.create_project, project_name)
     if project_id:
         await update.message.reply_text(f"Проект '{project_name}' создан с ID {project_id}.")
         context.user_data['selected_project_id'] = project_id
@@ -60,7 +225,7 @@ async def new_project(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
 async def list_projects(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Lists all available projects."""
-    projects = db.list_projects()
+    projects = await _db(db.list_projects)
     if not projects:
         await update.message.reply_text("Проектов пока нет. Создайте новый с помощью /new_project.")
         return
@@ -85,7 +250,8 @@ async def programmer_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     enabled = context.args[0].lower() == 'on'
-    db.set_programmer_mode(project_id, enabled)
+    await _db(db.set_programmer_mode, project_id, enabled)
+    context.bot_data["mode_cache"][project_id] = enabled
     status = "включен" if enabled else "выключен"
     await update.message.reply_text(f"Режим программиста {status} для текущего проекта.")
 
@@ -98,15 +264,13 @@ async def select_project(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     try:
         project_id = int(context.args[0])
-        projects = db.list_projects()
-        project_ids = [p['id'] for p in projects]
+        project = await _db(db.get_project, project_id)
 
-        if project_id not in project_ids:
+        if not project:
             await update.message.reply_text("Проект с таким ID не найден.")
             return
 
         context.user_data['selected_project_id'] = project_id
-        project = next((p for p in projects if p['id'] == project_id), None)
         project_name = project['name']
 
         message = f"Выбран проект: '{project_name}' (ID: {project_id}).\n"
@@ -148,7 +312,7 @@ async def add_ssh_credential_handler(update: Update, context: ContextTypes.DEFAU
         key_content = await key_file.download_as_bytearray()
         key = key_content.decode()
 
-        cred_id = db.add_ssh_credential(name, host, port, username, key)
+        cred_id = await _db(db.add_ssh_credential, name, host, port, username, key)
         if cred_id:
             await update.message.reply_text(f"SSH credential '{name}' added with ID {cred_id}.")
         else:
@@ -159,7 +323,7 @@ async def add_ssh_credential_handler(update: Update, context: ContextTypes.DEFAU
 
 async def list_ssh_credentials_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Lists all SSH credentials."""
-    credentials = db.list_ssh_credentials()
+    credentials = await _db(db.list_ssh_credentials)
     if not credentials:
         await update.message.reply_text("No SSH credentials found. Use /add_ssh to add one.")
         return
@@ -183,7 +347,7 @@ async def select_ssh_credential_handler(update: Update, context: ContextTypes.DE
 
     try:
         credential_id = int(context.args[0])
-        db.set_project_remote_server(project_id, credential_id)
+        await _db(db.set_project_remote_server, project_id, credential_id)
         await update.message.reply_text(f"SSH credential {credential_id} selected for the current project.")
     except (ValueError, IndexError):
         await update.message.reply_text("Invalid credential ID.")
@@ -199,156 +363,329 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     task_description = update.message.text
     logger.info(f"Received task for project {project_id}: {task_description}")
 
-    if db.is_programmer_mode_enabled(project_id):
+    # Updates are processed concurrently, so the task is queued before the
+    # first await to keep tasks from one chat in the order they were sent
+    _enqueue_chat_job(
+        context, update.effective_chat.id,
+        lambda: _run_task(project_id, task_description, update, context)
+    )
+
+async def _run_task(project_id: int, task_description: str, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Acknowledges a task and runs it in its project's mode. Executed from the chat's job queue."""
+    # Served from memory so the hot path skips the worker-thread hop to the database
+    mode_cache = context.bot_data["mode_cache"]
+    enabled = mode_cache.get(project_id)
+    if enabled is None:
+        enabled = await _db(db.is_programmer_mode_enabled, project_id)
+        # /programmer_mode may have set the mode while the lookup was running
+        enabled = mode_cache.setdefault(project_id, enabled)
+
+    if enabled:
         await update.message.reply_text(f"Получил задачу: '{task_description}'.\n✅ Режим программиста активен. Начинаю автономную работу...")
-        asyncio.create_task(run_programmer_mode_session(project_id, task_description, update, context))
+        await run_programmer_mode_session(project_id, task_description, update, context)
     else:
-        await update.message.reply_text(f"Получил задачу: '{task_description}'.\nДумаю над планом...")
-        await handle_standard_mode(project_id, task_description, update, context)
+        status_message = await update.message.reply_text(f"Получил задачу: '{task_description}'.\nДумаю над планом...")
+        await handle_standard_mode(project_id, task_description, update, context, status_message=status_message)
 
-async def handle_standard_mode(project_id: int, task_description: str, update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handles task in standard mode with user confirmation."""
+async def _edit_status(message, text: str, parse_mode: Optional[str] = None) -> None:
+    """Edits a status message, ignoring failures (e.g. unchanged text)."""
     try:
-        history = db.get_project_history(project_id)
-        gemini_client = context.bot_data["gemini_client"]
+        await message.edit_text(text[:_MESSAGE_LIMIT], parse_mode=parse_mode)
+    except Exception as e:
+        logger.debug(f"Failed to edit status message: {e}")
+
+def _stream_preview(message, header: str):
+    """
+    Returns an on_chunk callback for GeminiClient.get_commands that mirrors the
+    streamed text into `message`, at most once per STREAM_EDIT_INTERVAL.
+    Edits run in the background so a rate-limited edit never holds up reading
+    the stream; while one is still in flight, newer previews are skipped.
+    """
+    last_edit = 0.0
+    pending: Optional[asyncio.Task] = None
+
+    async def on_chunk(text: str) -> None:
+        nonlocal last_edit, pending
+        now = time.monotonic()
+        if now - last_edit < STREAM_EDIT_INTERVAL or (pending is not None and not pending.done()):
+            return
+        last_edit = now
+        pending = asyncio.create_task(_edit_status(message, header + text))
+
+    return on_chunk
 
-        command_string = gemini_client.get_commands(task_description, history, is_programmer_mode=False)
-        commands = [cmd for cmd in command_string.split('\n') if cmd.strip()]
+def _plan_cache_key(task_description: str) -> str:
+    """
+    Normalizes whitespace so re-sent tasks share a cache entry. Case is kept:
+    paths and names in a task are case-sensitive.
+    """
+    return " ".join(task_description.split())
+
+async def handle_standard_mode(project_id: int, task_description: str, update: Update, context: ContextTypes.DEFAULT_TYPE, status_message=None):
+    """Handles task in standard mode with user confirmation."""
+    try:
+        use_cache = PLAN_CACHE_DIRECTIVE not in task_description
+        if not use_cache:
+            task_description = task_description.replace(PLAN_CACHE_DIRECTIVE, "").strip()
+        task_key = _plan_cache_key(task_description)
+        plan_cache = context.bot_data["plan_cache"]
+        cache_key = (project_id, task_key)
+
+        commands = plan_cache.get(cache_key) if use_cache else None
+        if commands is not None:
+            logger.info(f"Plan cache hit for project {project_id}: '{task_key}'")
+        else:
+            if use_cache:
+                logger.info(f"Plan cache miss for project {project_id}: '{task_key}'")
+            command_string = await _db(db.get_cached_plan, project_id, task_key, PLAN_CACHE_TTL) if use_cache else None
+            from_db = command_string is not None
+            if not from_db:
+                history = await _db(db.get_project_history, project_id)
+                gemini_client = context.bot_data["gemini_client"]
+
+                on_chunk = None
+                if status_message:
+                    on_chunk = _stream_preview(status_message, f"Получил задачу: '{task_description}'.\nДумаю над планом...\n\n")
+                # The plan caches above already decide reuse (with a TTL and the
+                # #nocache directive), so the client's prompt cache is bypassed
+                command_string = await gemini_client.get_commands(
+                    task_description, history, is_programmer_mode=False, on_chunk=on_chunk, use_cache=False
+                )
+            commands = _NON_EMPTY_LINE.findall(command_string)
+            if use_cache and commands:
+                plan_cache[cache_key] = commands
+                if not from_db:
+                    await _db(db.cache_plan, project_id, task_key, "\n".join(commands))
 
         if not commands:
             await update.message.reply_text("Не удалось составить план. Попробуйте переформулировать.")
             return
 
         plan_str = "\n".join(commands)
-        task_id = db.create_task(project_id, task_description, plan_str)
-        context.chat_data[task_id] = commands
+        task_id = await _db(db.create_task, project_id, task_description, plan_str)
+        context.bot_data["pending_plans"][(update.effective_chat.id, task_id)] = commands
 
-        plan_text = "Вот план, который я предлагаю:\n\n```\n" + plan_str + "\n```"
-        keyboard = [[
-            InlineKeyboardButton("✅ Выполнить", callback_data=f"confirm_{task_id}"),
-            InlineKeyboardButton("❌ Отклонить", callback_data=f"cancel_{task_id}"),
-        ]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(plan_text, reply_markup=reply_markup, parse_mode='MarkdownV2')
+        plan_text = _code_message("Вот план, который я предлагаю:\n", plan_str)
+        await update.message.reply_text(plan_text, reply_markup=plan_markup(task_id), parse_mode='MarkdownV2')
 
     except Exception as e:
         logger.error(f"An error occurred in handle_standard_mode: {e}")
         await update.message.reply_text(f"Произошла ошибка: {e}")
 
 
+async def _fit_history(gemini_client: GeminiClient, entries: List, maxlen: int = SESSION_HISTORY_SIZE) -> deque:
+    """
+    Returns `entries` as a deque of at most `maxlen`. When they do not all fit,
+    everything but the newest half is replaced by a single Gemini-written
+    summary entry; if summarizing fails, only the newest entries are kept.
+    """
+    if len(entries) <= maxlen:
+        return deque(entries, maxlen=maxlen)
+    keep = maxlen // 2
+    older, newer = entries[:-keep], entries[-keep:]
+    summary = await gemini_client.summarize_history(older)
+    if not summary:
+        return deque(entries, maxlen=maxlen)
+    return deque([("Summary of earlier steps", "", summary, "summarized"), *newer], maxlen=maxlen)
+
 async def run_programmer_mode_session(project_id: int, task_description: str, update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Runs a task autonomously in programmer mode."""
     gemini_client = context.bot_data["gemini_client"]
-    history = db.get_project_history(project_id)
-    task_id = db.create_task(project_id, task_description, "Autonomous session")
+    # Only the latest entries are sent; older ones are summarized as they overflow
+    history = await _fit_history(gemini_client, await _db(db.get_project_history, project_id))
+    task_id = await _db(db.create_task, project_id, task_description, "Autonomous session")
 
     ssh_creds = None
-    project = next((p for p in db.list_projects() if p['id'] == project_id), None)
+    project = await _db(db.get_project, project_id)
     if project and project.get('remote_server_id'):
-        ssh_creds = db.get_ssh_credential(project['remote_server_id'])
+        ssh_creds = await _db(db.get_ssh_credential, project['remote_server_id'])
 
     last_command_output = None
-    full_log = []
     max_steps = 20 # Safety break
 
-    for i in range(max_steps):
-        await update.message.reply_text(f"Шаг {i+1}/{max_steps}. Думаю над следующей командой...")
+    # One status message is edited in place for every step; only long step
+    # reports and the final outcome are sent as new messages. A short report
+    # stays at the top of the status message until the next step's report.
+    previous_report = ""
+    status_message = await update.message.reply_text(f"Шаг 1/{max_steps}. Думаю над следующей командой...")
 
-        command_to_execute = gemini_client.get_commands(
-            task_description, history, is_programmer_mode=True, last_command_output=last_command_output
-        )
+    # The static prompt is cached server-side when possible; later steps then
+    # send only what happened in this session instead of the whole history.
+    session = await gemini_client.create_cached_content(task_description, list(history))
+    session_steps = deque(maxlen=SESSION_HISTORY_SIZE)
 
-        if not command_to_execute or command_to_execute.strip().upper() == "TASK_COMPLETE":
-            await update.message.reply_text("✅ Задача выполнена.")
-            db.update_task_log(task_id, json.dumps(full_log, indent=2))
-            return
+    try:
+        for i in range(max_steps):
+            if i:
+                thinking = escape_markdown(f"Шаг {i+1}/{max_steps}. Думаю над следующей командой...", version=2)
+                await _edit_status(status_message, _with_report(previous_report, thinking), parse_mode='MarkdownV2')
+            if session:
+                command_to_execute = await gemini_client.generate_with_cache(session, session_steps, last_command_output)
+            else:
+                command_to_execute = await gemini_client.get_commands(
+                    task_description, history, is_programmer_mode=True, last_command_output=last_command_output
+                )
+
+            if not command_to_execute or command_to_execute.strip().upper() == "TASK_COMPLETE":
+                await update.message.reply_text("✅ Задача выполнена.")
+                await _db(db.finalize_task_log, task_id)
+                return
+
+            await _edit_status(
+                status_message,
+                _with_report(previous_report, _code_message(f"Шаг {i+1}/{max_steps}. Выполняю команду:", command_to_execute)),
+                parse_mode='MarkdownV2'
+            )
+            result = await asyncio.to_thread(execute_command, command_to_execute, ssh_creds)
+
+            # Format output for the next AI prompt and for the user
+            last_command_output = (
+                f"Command: {result.command}\n"
+                f"Return Code: {result.returncode}\n"
+                f"STDOUT:\n{result.stdout}\n"
+                f"STDERR:\n{result.stderr}\n"
+            )
+            # Each step's result is encoded once, stored right away and reused for the history
+            result_json = _LOG_ENCODER.encode(asdict(result))
+            await _db(db.append_task_log_step, task_id, i, result_json)
+
+            report_message = _code_message(f"Отчет по шагу {i+1}:", last_command_output)
+            if len(report_message) > STEP_REPORT_MESSAGE_THRESHOLD:
+                await update.message.reply_text(report_message, parse_mode='MarkdownV2')
+                previous_report = ""
+            else:
+                await _edit_status(status_message, report_message, parse_mode='MarkdownV2')
+                previous_report = report_message
+
+            # Update history for the next iteration
+            step = (
+                f"Step {i+1} of '{task_description}'",
+                command_to_execute,
+                result_json,
+                "completed"
+            )
+            # Only the entries sent to the model are kept
+            if session:
+                session_steps = await _fit_history(gemini_client, [*session_steps, step])
+            else:
+                history = await _fit_history(gemini_client, [*history, step])
+
+        await update.message.reply_text("⚠️ Достигнуто максимальное количество шагов. Сессия завершена.")
+        await _db(db.finalize_task_log, task_id)
+    finally:
+        if session:
+            await gemini_client.delete_cached_content(session)
+
+
+async def _confirm_handler(query, task_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Queues a pending plan for execution in its chat."""
+    chat_id = query.message.chat.id
+    commands = context.bot_data["pending_plans"].pop((chat_id, task_id), None)
+    if not commands:
+        await query.answer()
+        await query.edit_message_text(text="Не удалось найти план. Возможно, сессия истекла.")
+        return
+
+    # Queued before the first await, so plans run in the order they were confirmed
+    _enqueue_chat_job(context, chat_id, lambda: _run_accepted_plan(query, task_id, commands))
+    await query.answer()
 
-        await update.message.reply_text(f"Выполняю команду:\n```\n{command_to_execute}\n```", parse_mode='MarkdownV2')
-        result = execute_command(command_to_execute, ssh_creds)
 
-        # Format output for the next AI prompt and for the user
-        last_command_output = (
-            f"Command: {result['command']}\n"
-            f"Return Code: {result['returncode']}\n"
-            f"STDOUT:\n{result['stdout']}\n"
-            f"STDERR:\n{result['stderr']}\n"
-        )
-        full_log.append(result)
+async def _run_accepted_plan(query, task_id: int, commands: List[str]) -> None:
+    """Acknowledges a confirmed plan and runs it. Executed from the chat's job queue."""
+    await query.edit_message_text(text="План принят. Выполняю команды...")
+    await run_confirmed_plan(query, task_id, commands)
 
-        report_message = f"Отчет по шагу {i+1}:\n" + f"```\n{last_command_output}\n```"
-        if len(report_message) > 4096:
-            report_message = report_message[:4000] + "\n... (отчет был обрезан)"
-        await update.message.reply_text(report_message, parse_mode='MarkdownV2')
 
-        # Update history for the next iteration
-        history.append({
-            "description": f"Step {i+1} of '{task_description}'",
-            "plan": command_to_execute,
-            "execution_log": json.dumps(result),
-            "status": "completed"
-        })
+async def _cancel_handler(query, task_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Drops a pending plan."""
+    context.bot_data["pending_plans"].pop((query.message.chat.id, task_id), None)
+    await query.answer()
+    # TODO: Update task status to 'cancelled' in the database
+    await query.edit_message_text(text="План выполнения отклонен.")
+
 
-    await update.message.reply_text("⚠️ Достигнуто максимальное количество шагов. Сессия завершена.")
-    db.update_task_log(task_id, json.dumps(full_log, indent=2))
+# Callback action -> handler(query, task_id, context). Handlers answer the query
+# themselves, after queuing any chat work.
+_CALLBACK_HANDLERS: Dict[str, Callable[..., Awaitable[None]]] = {
+    "c": _confirm_handler,
+    "x": _cancel_handler,
+}
 
 
 async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Parses the user's choice and executes commands."""
     query = update.callback_query
-    await query.answer()
-
-    action, task_id_str = query.data.split('_')
-    task_id = int(task_id_str)
-
-    commands = context.chat_data.pop(task_id, None)
-
-    if action == "cancel":
-        # TODO: Update task status to 'cancelled' in the database
-        await query.edit_message_text(text="План выполнения отклонен.")
+    match = _CB_RE.match(query.data or "")
+    if match is None:
+        await query.answer()
+        await query.edit_message_text(text="Неизвестное действие.")
         return
 
-    if not commands:
-        await query.edit_message_text(text="Не удалось найти план. Возможно, сессия истекла.")
-        return
+    await _CALLBACK_HANDLERS[match.group(1)](query, int(match.group(2)), context)
 
-    await query.edit_message_text(text="План принят. Выполняю команды...")
 
-    project_id = db.get_project_id_from_task(task_id)
+async def run_confirmed_plan(query, task_id: int, commands: List[str]) -> None:
+    """Executes a confirmed plan, stores its log and replies with a report."""
+    project_id = await _db(db.get_project_id_from_task, task_id)
     ssh_creds = None
     if project_id:
-        project = next((p for p in db.list_projects() if p['id'] == project_id), None)
+        project = await _db(db.get_project, project_id)
         if project and project.get('remote_server_id'):
-            ssh_creds = db.get_ssh_credential(project['remote_server_id'])
+            ssh_creds = await _db(db.get_ssh_credential, project['remote_server_id'])
 
-    results = execute_commands(commands, ssh_creds)
-    log_json = json.dumps(results, indent=2)
+    # Commands can run for minutes; keep the event loop free meanwhile
+    results = await execute_commands_async(commands, ssh_creds)
+    log_json = _LOG_ENCODER.encode([asdict(res) for res in results])
 
     # Save execution log to the database
-    db.update_task_log(task_id, log_json)
+    await _db(db.update_task_log, task_id, log_json)
+
+    report = _join_markdown(_report_fragments(results))
+
+    await query.message.reply_text(report, parse_mode='MarkdownV2')
+
 
-    report = "--- Отчет о выполнении ---\n\n"
+def _report_fragments(results: List[CommandResult]) -> Iterator[Tuple[str, bool]]:
+    """
+    Yields the pieces of an execution report in order, escaped for MarkdownV2,
+    as (text, is_code_block_body) pairs for _join_markdown.
+    """
+    yield escape_markdown("--- Отчет о выполнении ---\n\n", version=2), False
     for res in results:
-        report += f"Команда: `{res['command']}`\n"
-        report += f"Код возврата: {res['returncode']}\n"
-        if res['stdout']:
-            report += f"Вывод (stdout):\n```\n{res['stdout']}\n```\n"
-        if res['stderr']:
-            report += f"Ошибки (stderr):\n```\n{res['stderr']}\n```\n"
-        report += "---\n"
+        command = escape_markdown(res.command, version=2, entity_type='code')
+        yield f"Команда: `{command}`\n" + escape_markdown(f"Код возврата: {res.returncode}\n", version=2), False
+        for label, output in (("Вывод (stdout):", res.stdout), ("Ошибки (stderr):", res.stderr)):
+            if output:
+                yield escape_markdown(label, version=2) + _CODE_FENCE_OPEN, False
+                yield escape_markdown(output, version=2, entity_type='pre'), True
+                yield _CODE_FENCE_CLOSE + "\n", False
+        yield escape_markdown("---\n", version=2), False
 
-    if len(report) > 4096:
-        report = report[:4000] + "\n... (отчет был обрезан)"
 
-    await query.message.reply_text(report, parse_mode='Markdown')
+async def _optimize_database(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Job queue callback that drops expired cached plans and keeps SQLite's
+    planner statistics fresh while the bot runs.
+    """
+    await _db(db.prune_plan_cache, PLAN_CACHE_TTL)
+    await _db(db.optimize_database)
 
 
 def main() -> None:
     """Initializes and starts the bot."""
     # --- Critical Setup ---
-    if not TELEGRAM_BOT_TOKEN:
+    # The .env file is only read when the bot actually starts, not on import
+    load_dotenv(dotenv_path='src/.env')
+    telegram_bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
+    gemini_api_key = os.getenv("GEMINI_API_KEY")
+    # Optional: public base URL to receive updates via webhook instead of polling
+    webhook_url = os.getenv("WEBHOOK_URL")
+
+    if not telegram_bot_token:
         logger.critical("FATAL: Environment variable TELEGRAM_BOT_TOKEN is not set.")
         return
-    if not GEMINI_API_KEY:
+    if not gemini_api_key:
         logger.critical("FATAL: Environment variable GEMINI_API_KEY is not set.")
         return
 
@@ -356,10 +693,32 @@ def main() -> None:
     db.initialize_database()
 
     # Create the Application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(telegram_bot_token)
+        # Updates from different chats are handled concurrently, updates from
+        # one chat in order; long-running work goes to the chat worker queues
+        .concurrent_updates(PerChatUpdateProcessor(32))
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1))
+        .build()
+    )
+
+    # The job queue starts and stops with the application
+    application.job_queue.run_repeating(
+        _optimize_database, interval=DB_OPTIMIZE_INTERVAL, first=DB_OPTIMIZE_INTERVAL
+    )
 
     # Store the Gemini client in bot_data
-    application.bot_data["gemini_client"] = GeminiClient(api_key=GEMINI_API_KEY)
+    application.bot_data["gemini_client"] = GeminiClient(api_key=gemini_api_key)
+    # Recently proposed plans, keyed by (project_id, normalized task)
+    application.bot_data["plan_cache"] = TTLCache(maxsize=1024, ttl=600)
+    # Plans awaiting confirmation, keyed by (chat_id, task_id). Plans that are
+    # never confirmed or cancelled expire instead of accumulating.
+    application.bot_data["pending_plans"] = TTLCache(maxsize=10_000, ttl=3600)
+    # Programmer mode per project, kept in sync by the programmer_mode handler
+    application.bot_data["mode_cache"] = {}
+    # Per-chat job queues, see _enqueue_chat_job
+    application.bot_data["chat_workers"] = {}
 
     # --- Add Handlers ---
     application.add_handler(CommandHandler("start", start))
@@ -372,11 +731,19 @@ def main() -> None:
     application.add_handler(CommandHandler("list_ssh", list_ssh_credentials_handler))
     application.add_handler(CommandHandler("select_ssh", select_ssh_credential_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_handler(CallbackQueryHandler(button_callback_handler, pattern="^(confirm|cancel)_"))
+    application.add_handler(CallbackQueryHandler(button_callback_handler, pattern=_CB_RE))
 
     # Run the bot
     logger.info("Bot is running...")
-    application.run_polling()
+    if webhook_url:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("WEBHOOK_PORT", "8443")),
+            url_path=telegram_bot_token,
+            webhook_url=f"{webhook_url.rstrip('/')}/{telegram_bot_token}",
+        )
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file